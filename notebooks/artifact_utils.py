@@ -0,0 +1,147 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+import functools
+import types
+import pandas as pd
+
+SIMPLE_TYPES = (str, int, float, bool, type(None), list, tuple, dict)
+
+def code_bytes(code):
+    # Bytecode and constants, including nested functions and comprehensions, without the memory
+    # addresses that the repr of a code object contains
+    parts = [code.co_code, repr(code.co_names).encode()]
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            parts.append(code_bytes(const))
+        elif isinstance(const, frozenset):
+            # Set literals - their order depends on the process's hash seed
+            parts.append(repr(sorted(map(repr, const))).encode())
+        else:
+            parts.append(repr(const).encode())
+    return b"\0".join(parts)
+
+def code_fingerprint(*objects):
+    """
+    Hash of the code of functions, or of every method of classes, and of the arguments bound to
+    them (defaults, functools.partial arguments and simple closure values). Part of a memoised
+    stage's key, so a change to the logic or its parameters re-runs the stage.
+    """
+    digest = hashlib.sha256()
+    for obj in objects:
+        if isinstance(obj, functools.partial):
+            digest.update(json.dumps([obj.args, obj.keywords], sort_keys=True, default=str).encode())
+            obj = obj.func
+        if isinstance(obj, type):
+            functions = [getattr(value, "__func__", value) for _, value in sorted(vars(obj).items())]
+        else:
+            functions = [obj]
+        for function in functions:
+            code = getattr(function, "__code__", None)
+            if code is None:
+                continue
+            digest.update(code_bytes(code))
+            bound = [function.__defaults__, function.__kwdefaults__]
+            bound += [cell.cell_contents for cell in function.__closure__ or ()
+                      if isinstance(cell.cell_contents, SIMPLE_TYPES)]
+            digest.update(json.dumps(bound, sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+class ArtifactStore:
+    """
+    Passes DataFrames between pipeline stages in memory and, optionally, persists them as
+    content-addressed Parquet files so that a stage whose inputs are unchanged can be skipped.
+    """
+    def __init__(self, artifact_dir=None, persist=False):
+        self.artifact_dir = artifact_dir or os.path.join("..", "data", "artifacts")
+        self.persist = persist
+        self.index_file = os.path.join(self.artifact_dir, "stage_index.json")
+        self.artifacts = {}
+        self.hashes = {}
+        # Stages may run concurrently and share the index file
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def content_hash(value):
+        digest = hashlib.sha256()
+        if isinstance(value, pd.DataFrame):
+            digest.update(json.dumps([list(map(str, value.columns)), list(map(str, value.dtypes))]).encode())
+            digest.update(pd.util.hash_pandas_object(value, index=False).to_numpy().tobytes())
+        elif hasattr(value, "content_digest"):
+            # Data held on disk, e.g. a KeySpill, hashed by what it holds rather than how it prints
+            digest.update(value.content_digest().encode())
+        else:
+            digest.update(json.dumps(value, sort_keys=True, default=str).encode())
+        return digest.hexdigest()
+
+    def artifact_path(self, content_hash):
+        return os.path.join(self.artifact_dir, f"{content_hash}.parquet")
+
+    def put(self, name, value, persist=True):
+        # Large inputs can be held in memory only - their hash is all a stage key needs
+        self.artifacts[name] = value
+        self.hashes.pop(name, None)
+        if self.persist and persist and isinstance(value, pd.DataFrame):
+            content_hash = self.hash_of(name)
+            if not os.path.exists(self.artifact_path(content_hash)):
+                os.makedirs(self.artifact_dir, exist_ok=True)
+                # Only the categories in use, not the whole shared registry, are worth storing
+                value = value.apply(lambda column: column.cat.remove_unused_categories()
+                                    if isinstance(column.dtype, pd.CategoricalDtype) else column)
+                value.to_parquet(self.artifact_path(content_hash), index=False)
+
+    def get(self, name):
+        return self.artifacts[name]
+
+    def hash_of(self, name):
+        # Hashes are computed when first needed, as hashing large frames is not free
+        if name not in self.hashes:
+            self.hashes[name] = self.content_hash(self.artifacts[name])
+        return self.hashes[name]
+
+    def load_stage_index(self):
+        if os.path.exists(self.index_file):
+            with open(self.index_file, 'r') as f:
+                return json.load(f)
+        return {}
+
+    def save_stage_index(self, stage_index):
+        os.makedirs(self.artifact_dir, exist_ok=True)
+        with open(self.index_file, 'w') as f:
+            json.dump(stage_index, f, indent=4)
+
+    def stage_key(self, stage_name, input_names, version=None):
+        key = json.dumps([stage_name, version] + [[name, self.hash_of(name)] for name in sorted(input_names)])
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def run_stage(self, stage_name, func, input_names, output_names, version=None):
+        """
+        Calls func with the named artifacts as keyword arguments and stores the outputs it returns
+        (a tuple in the order of output_names). If persisted outputs exist for the same input hashes
+        and version they are loaded instead of calling func. The version defaults to a fingerprint
+        of func's code.
+        """
+        key = self.stage_key(stage_name, input_names, version or code_fingerprint(func))
+        if self.persist:
+            cached = self.load_stage_index().get(key)
+            if cached and all(os.path.exists(self.artifact_path(cached[name])) for name in output_names):
+                logging.info(f"Inputs to {stage_name} unchanged, loading outputs from artifacts")
+                for name in output_names:
+                    self.artifacts[name] = pd.read_parquet(self.artifact_path(cached[name]))
+                    self.hashes[name] = cached[name]
+                return tuple(self.artifacts[name] for name in output_names)
+
+        outputs = func(**{name: self.artifacts[name] for name in input_names})
+        if len(output_names) == 1:
+            outputs = (outputs,)
+        for name, value in zip(output_names, outputs):
+            self.put(name, value)
+
+        if self.persist:
+            with self.lock:
+                stage_index = self.load_stage_index()
+                stage_index[key] = {name: self.hash_of(name) for name in output_names}
+                self.save_stage_index(stage_index)
+        return tuple(self.artifacts[name] for name in output_names)
@@ -0,0 +1,50 @@
+import os
+import subprocess
+import sys
+import tempfile
+
+# Importing bsa_utils should be fast and should not import these or touch the filesystem
+HEAVY_MODULES = ["pandas", "requests", "grequests", "gevent"]
+MAX_IMPORT_SECONDS = 0.5
+
+def measure_import(runs=5):
+    notebooks_dir = os.path.dirname(os.path.abspath(__file__))
+    check = (
+        "import sys, time; start = time.perf_counter(); import bsa_utils; "
+        "elapsed = time.perf_counter() - start; "
+        f"print(elapsed); print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    )
+    timings = []
+    loaded = set()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Run from a scratch directory so any '../data' side effect is visible
+        working_dir = os.path.join(tmp_dir, "notebooks")
+        os.makedirs(working_dir)
+        env = dict(os.environ, PYTHONPATH=notebooks_dir)
+        for _ in range(runs):
+            output = subprocess.run(
+                [sys.executable, "-c", check], cwd=working_dir, env=env, capture_output=True, text=True, check=True
+            ).stdout.splitlines()
+            timings.append(float(output[0]))
+            loaded.update(m for m in output[1].split(',') if m)
+        created = os.listdir(tmp_dir)
+    return min(timings), sorted(loaded), created
+
+def main():
+    best, loaded, created = measure_import()
+    print(f"Import time for bsa_utils: {best * 1000:.1f} ms (best of 5)")
+    failures = []
+    if best > MAX_IMPORT_SECONDS:
+        failures.append(f"import took longer than {MAX_IMPORT_SECONDS * 1000:.0f} ms")
+    if loaded:
+        failures.append(f"heavy modules imported: {', '.join(loaded)}")
+    if created != ["notebooks"]:
+        failures.append(f"import created files: {', '.join(c for c in created if c != 'notebooks')}")
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    if failures:
+        sys.exit(1)
+    print("OK")
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,22 @@
 import os
 import json
-import grequests
-import requests
-import pandas as pd
 import gzip
 import io
+import hashlib
+import bisect
 import urllib.parse
 from datetime import datetime
 import logging
 import time
+import threading
 import warnings
 
-warnings.simplefilter("ignore", category=UserWarning)
+# pandas, requests and grequests are imported where they are used so that importing
+# this module is fast and free of side effects (grequests monkey-patches the process)
 
-logging.basicConfig(level=logging.WARNING)
+def configure_runtime():
+    warnings.simplefilter("ignore", category=UserWarning)
+    logging.basicConfig(level=logging.WARNING)
 
 class Config:
     """
@@ -25,80 +28,578 @@ class Config:
         self.package_show_method = 'package_show?id='
         self.action_method = 'datastore_search_sql?'
 
-        # Create data directory if it doesn't exist
+        # Resource fields which change when NHSBSA republishes a table, used to revalidate the cache
+        self.cache_metadata_fields = ['last_modified', 'revision_id']
+
+        # Concurrency used for API requests: "threads" (default) or "grequests" (gevent)
+        self.concurrency_backend = os.environ.get("BSA_CONCURRENCY_BACKEND", "threads")
+        # Starting and maximum number of concurrent requests, adjusted by AdaptiveConcurrency
+        self.initial_concurrency = int(os.environ.get("BSA_INITIAL_CONCURRENCY", 5))
+        self.max_concurrency = int(os.environ.get("BSA_MAX_CONCURRENCY", 16))
+
+        # Data directories are created when the cache is first written, not here
         self.DATA_DIR = os.path.join("..", "data")
         self.CACHE_DIR = os.path.join(self.DATA_DIR, "cache")
         self.CACHE_MAPPING_FILE = os.path.join(self.CACHE_DIR, "cache_mapping.json")
+        self.MANIFEST_DIR = os.path.join(self.DATA_DIR, "manifests")
 
-        self.create_directories()
+        # Response cache: "local" (CACHE_DIR), "sqlite:<path>" or the URL of a shared cache server
+        self.cache_backend = os.environ.get("BSA_CACHE_BACKEND", "local")
 
     def create_directories(self):
         os.makedirs(self.DATA_DIR, exist_ok=True)
         os.makedirs(self.CACHE_DIR, exist_ok=True)
 
-CONFIG_OBJ = Config()
+_CONFIG_OBJ = None
+_CACHE_MANAGER_OBJ = None
+# Guards creation of the shared objects when pulls run in several threads
+_SHARED_OBJ_LOCK = threading.RLock()
+
+def get_config():
+    global _CONFIG_OBJ
+    with _SHARED_OBJ_LOCK:
+        if _CONFIG_OBJ is None:
+            _CONFIG_OBJ = Config()
+    return _CONFIG_OBJ
 
 class CacheManager:
     """
     Manages caching of API responses to avoid redundant API calls.
     """
-    def __init__(self, cache_dir, cache_mapping_file):
+    def __init__(self, cache_dir=None, cache_mapping_file=None, backend=None):
+        from cache_backends import LocalCacheBackend
         self.cache_dir = cache_dir
         self.cache_mapping_file = cache_mapping_file
+        # Where entries are stored - a local directory unless a shared backend is given
+        self.backend = backend or LocalCacheBackend(cache_dir, cache_mapping_file)
+        # Pulls may run in several threads at once; backends lock against other processes themselves
+        self.lock = threading.RLock()
+
+    def save_to_cache(self, api_url, response_json, metadata=None):
+        # Raw response bytes are stored as they are, without parsing and re-serialising
+        payload = response_json if isinstance(response_json, bytes) else json.dumps(response_json).encode()
+        with self.lock:
+            try:
+                self.backend.put(api_url, payload, metadata)
+            except Exception as e:
+                # A shared cache being unavailable should not fail the pull
+                logging.warning(f"Could not save {api_url} to the cache: {e}")
+
+    def check_cache(self, api_url, metadata=None, raw=False):
+        # raw=True returns the cached bytes for decode_response rather than parsed JSON
+        with self.lock:
+            try:
+                return self._check_cache(api_url, metadata, raw)
+            except Exception as e:
+                logging.warning(f"Could not read {api_url} from the cache, fetching instead: {e}")
+                return None
+
+    def _check_cache(self, api_url, metadata, raw):
+        entry = self.backend.get(api_url)
+        if entry is None:
+            return None
+        payload, cached_metadata = entry
+        if metadata is not None:
+            if cached_metadata is None:
+                # Entry cached before metadata was recorded - adopt the current metadata rather than re-fetching
+                self.backend.set_metadata(api_url, metadata)
+            elif cached_metadata != metadata:
+                logging.info(f"Resource metadata changed for {api_url}, cache is out of date")
+                return None
+        logging.info(f"Retrieving {api_url} from cache")
+        return payload if raw else json.loads(payload)
+
+def get_cache_manager():
+    global _CACHE_MANAGER_OBJ
+    with _SHARED_OBJ_LOCK:
+        if _CACHE_MANAGER_OBJ is None:
+            config = get_config()
+            from cache_backends import make_cache_backend
+            backend = make_cache_backend(config.cache_backend, config.CACHE_DIR, config.CACHE_MAPPING_FILE)
+            _CACHE_MANAGER_OBJ = CacheManager(config.CACHE_DIR, config.CACHE_MAPPING_FILE, backend)
+    return _CACHE_MANAGER_OBJ
+
+class JobManifest:
+    """
+    Records the status of each month in a pull so an interrupted pull can be resumed.
+    """
+    PENDING = "pending"
+    FETCHED = "fetched"
+    NORMALISED = "normalised"
+    FAILED = "failed"
 
-    def load_cache_mapping(self):
-        if os.path.exists(self.cache_mapping_file):
-            with open(self.cache_mapping_file, 'r') as f:
+    def __init__(self, manifest_dir, resource, sql, resource_ids):
+        self.resource = resource
+        # A job is identified by its query and the months it covers
+        job_key = "|".join([resource, sql] + list(resource_ids))
+        job_hash = hashlib.sha1(job_key.encode()).hexdigest()[:12]
+        self.manifest_file = os.path.join(manifest_dir, f"{resource}_{job_hash}.json")
+        self.manifest = self.load_manifest()
+
+    def load_manifest(self):
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file, 'r') as f:
                 return json.load(f)
-        return {}
-
-    def save_cache_mapping(self, cache_mapping):
-        with open(self.cache_mapping_file, 'w') as f:
-            json.dump(cache_mapping, f, indent=4)
-
-    def save_to_cache(self, api_url, response_json):
-        cache_mapping = self.load_cache_mapping()
-        cache_file = os.path.join(self.cache_dir, f"cache_{len(cache_mapping) + 1}.json")
-        with open(cache_file, 'w') as f:
-            json.dump(response_json, f)
-        cache_mapping[api_url] = cache_file
-        self.save_cache_mapping(cache_mapping)
-
-    def check_cache(self, api_url):
-        cache_mapping = self.load_cache_mapping()
-        if api_url in cache_mapping:
-            cache_file = cache_mapping[api_url]
-            if os.path.exists(cache_file):
-                logging.info(f"Retrieving {api_url} from cache")
-                with open(cache_file, 'r') as f:
-                    return json.load(f)
-        return None
-
-CACHE_MANAGER_OBJ = CacheManager(CONFIG_OBJ.CACHE_DIR, CONFIG_OBJ.CACHE_MAPPING_FILE)
+        return {"complete": False, "months": {}}
+
+    def save_manifest(self):
+        os.makedirs(os.path.dirname(self.manifest_file), exist_ok=True)
+        tmp_file = f"{self.manifest_file}.tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(self.manifest, f, indent=4)
+        # Replace in one step so an interrupted write never leaves a corrupt manifest
+        os.replace(tmp_file, self.manifest_file)
+
+    def start(self, resource_ids, dates):
+        # A finished job starts afresh, an unfinished one keeps the status of its months
+        if self.manifest["complete"]:
+            self.manifest = {"complete": False, "months": {}}
+        months = self.manifest["months"]
+        for resource_id, date in zip(resource_ids, dates):
+            if resource_id not in months:
+                months[resource_id] = {"date": date, "status": self.PENDING}
+        self.save_manifest()
+
+    def is_resumable(self, resource_id):
+        return self.status(resource_id) in (self.FETCHED, self.NORMALISED)
+
+    def status(self, resource_id):
+        month = self.manifest["months"].get(resource_id)
+        return month["status"] if month else None
+
+    def set_status(self, resource_id, status, error=None):
+        month = self.manifest["months"].setdefault(resource_id, {"date": None})
+        month["status"] = status
+        if error:
+            month["error"] = error
+        else:
+            month.pop("error", None)
+        self.save_manifest()
+
+    def incomplete_months(self, resource_ids):
+        return [
+            self.manifest["months"][resource_id]["date"]
+            for resource_id in resource_ids
+            if self.status(resource_id) != self.NORMALISED
+        ]
+
+    def mark_complete(self):
+        self.manifest["complete"] = True
+        self.save_manifest()
+
+class CategoryRegistry:
+    """
+    Shared, append-only category sets so that string columns from every month, and from every
+    FetchData given the same registry, are encoded against consistent categories.
+    """
+    def __init__(self):
+        self.categories = {}
+        # Encoding appends categories, so concurrent pulls sharing a registry must take turns
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def is_text_column(series):
+        import pandas as pd
+        return pd.api.types.is_object_dtype(series.dtype) or isinstance(series.dtype, pd.StringDtype)
+
+    def encode(self, df):
+        with self.lock:
+            return self._encode(df)
+
+    def _encode(self, df):
+        import pandas as pd
+        df = df.copy(deep=False)
+        for column in df.columns:
+            if not self.is_text_column(df[column]):
+                continue
+            known = self.categories.get(column, pd.Index([], dtype=object))
+            uniques = pd.Index(pd.unique(df[column].dropna()), dtype=object)
+            new_values = uniques[~uniques.isin(known)]
+            if len(new_values):
+                # New values are appended so codes already handed out stay valid
+                known = known.append(new_values)
+                self.categories[column] = known
+            df[column] = pd.Categorical.from_codes(known.get_indexer(df[column]), categories=known)
+        return df
+
+    def align(self, df):
+        # Extend categorical columns encoded earlier to the registry's current categories
+        import pandas as pd
+        df = df.copy(deep=False)
+        for column, categories in self.categories.items():
+            if column in df.columns and isinstance(df[column].dtype, pd.CategoricalDtype):
+                if len(df[column].cat.categories) < len(categories):
+                    df[column] = pd.Categorical.from_codes(df[column].cat.codes, categories=categories)
+        return df
+
+def __getattr__(name):
+    # CONFIG_OBJ and CACHE_MANAGER_OBJ are built on first access rather than at import
+    if name == "CONFIG_OBJ":
+        return get_config()
+    if name == "CACHE_MANAGER_OBJ":
+        return get_cache_manager()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+class AdaptiveConcurrency:
+    """
+    AIMD controller for the number of concurrent API requests, with jittered retry delays.
+    """
+    def __init__(self, initial_limit=5, min_limit=1, max_limit=16, latency_tolerance=2.0, max_error_rate=0.1,
+                 decrease_factor=0.5, base_delay=1.0, max_delay=60.0, window=20):
+        from collections import deque
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_tolerance = latency_tolerance
+        self.max_error_rate = max_error_rate
+        self.decrease_factor = decrease_factor
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.latencies = deque(maxlen=window)
+        self.outcomes = deque(maxlen=window)
+        self.min_latency = None
+        self.last_decrease = 0.0
+        self.lock = threading.Lock()
+
+    @property
+    def current_limit(self):
+        return int(self.limit)
+
+    def median_latency(self):
+        import statistics
+        return statistics.median(self.latencies) if self.latencies else None
+
+    def is_healthy(self):
+        error_rate = self.outcomes.count(False) / len(self.outcomes)
+        # Latency well above the best seen suggests the API is queueing our requests
+        return error_rate <= self.max_error_rate and self.median_latency() <= self.latency_tolerance * self.min_latency
+
+    def record_success(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+            self.outcomes.append(True)
+            self.min_latency = latency if self.min_latency is None else min(self.min_latency, latency)
+            if self.is_healthy() and self.limit < self.max_limit:
+                # Additive increase: roughly one extra request per round of successes
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+                logging.debug(f"Concurrency limit raised to {self.limit:.2f}")
+
+    def record_failure(self):
+        with self.lock:
+            self.outcomes.append(False)
+            now = time.monotonic()
+            # Back off at most once per typical request time so one overload episode counts once
+            if now - self.last_decrease >= (self.median_latency() or self.base_delay):
+                self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+                self.last_decrease = now
+                logging.info(f"Concurrency limit reduced to {self.current_limit}")
+
+    @staticmethod
+    def parse_retry_after(response):
+        if response is None or 'Retry-After' not in response.headers:
+            return None
+        value = response.headers['Retry-After']
+        if value.isdigit():
+            return float(value)
+        try:
+            from email.utils import parsedate_to_datetime
+            return max(0.0, (parsedate_to_datetime(value) - datetime.now(tz=parsedate_to_datetime(value).tzinfo)).total_seconds())
+        except (TypeError, ValueError):
+            return None
+
+    def retry_delay(self, attempt, response=None):
+        import random
+        retry_after = self.parse_retry_after(response)
+        if retry_after is not None:
+            # Honour the server, with a little jitter so retries do not arrive together
+            return retry_after + random.uniform(0, self.base_delay)
+        # Full jitter exponential backoff
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+        return {
+            "limit": self.current_limit,
+            "median_latency": self.median_latency(),
+            "p95_latency": latencies[int(0.95 * (len(latencies) - 1))] if latencies else None,
+            "min_latency": self.min_latency,
+            "error_rate": self.outcomes.count(False) / len(self.outcomes) if self.outcomes else 0.0,
+        }
+
+_CONCURRENCY_OBJ = None
+
+def get_concurrency_controller():
+    # Shared so that concurrent pulls in one process back off together
+    global _CONCURRENCY_OBJ
+    with _SHARED_OBJ_LOCK:
+        if _CONCURRENCY_OBJ is None:
+            config = get_config()
+            _CONCURRENCY_OBJ = AdaptiveConcurrency(config.initial_concurrency, max_limit=config.max_concurrency)
+    return _CONCURRENCY_OBJ
+
+def is_retryable(response):
+    # Rate limiting, server errors and failed connections are worth retrying, other client errors are not
+    return response is None or response.status_code == 429 or response.status_code >= 500
+
+def iter_responses(urls, max_attempts=3, controller=None, backend=None):
+    """
+    Yields (url, response) for each URL once it succeeds, fails permanently or runs out of attempts.
+    The response is None if the final attempt raised.
+    """
+    backend = backend or get_config().concurrency_backend
+    controller = controller or get_concurrency_controller()
+    if backend == "grequests":
+        yield from _iter_grequests_responses(urls, max_attempts, controller)
+    elif backend == "threads":
+        yield from _iter_threaded_responses(urls, max_attempts, controller)
+    else:
+        raise ValueError(f"Unknown concurrency backend '{backend}'. Expected 'threads' or 'grequests'.")
+
+def _iter_threaded_responses(urls, max_attempts, controller):
+    import heapq
+    import requests
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+    # Heap of (ready_time, url, attempt) so each retry waits on its own delay
+    queue = [(0.0, url, 1) for url in urls]
+    heapq.heapify(queue)
+    in_flight = {}
+    with requests.Session() as session, ThreadPoolExecutor(max_workers=controller.max_limit) as executor:
+        while queue or in_flight:
+            now = time.monotonic()
+            while queue and queue[0][0] <= now and len(in_flight) < controller.current_limit:
+                _, url, attempt = heapq.heappop(queue)
+                in_flight[executor.submit(session.get, url)] = (url, attempt, time.monotonic())
+
+            # Wake for the next queued retry only if there is room to send it, otherwise wait for a
+            # request to finish - a zero timeout at the limit would spin
+            if queue and len(in_flight) < controller.current_limit:
+                timeout = max(0.0, queue[0][0] - now)
+            else:
+                timeout = None
+            if not in_flight:
+                time.sleep(timeout)
+                continue
+            done, _ = wait(in_flight, timeout=timeout, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                url, attempt, started = in_flight.pop(future)
+                try:
+                    response = future.result()
+                except requests.RequestException as e:
+                    logging.error(f"Request failed for {url}: {e}")
+                    response = None
+                if response is not None and response.status_code == 200:
+                    controller.record_success(time.monotonic() - started)
+                    yield url, response
+                elif is_retryable(response) and attempt < max_attempts:
+                    controller.record_failure()
+                    delay = controller.retry_delay(attempt, response)
+                    status = response.status_code if response is not None else "no response"
+                    logging.error(f"Error {status} for {url}. Will retry in {delay:.1f}s.")
+                    heapq.heappush(queue, (time.monotonic() + delay, url, attempt + 1))
+                else:
+                    if is_retryable(response):
+                        controller.record_failure()
+                    yield url, response
+
+def _iter_grequests_responses(urls, max_attempts, controller):
+    import grequests
+
+    remaining = list(urls)
+    retry_response = None
+    for attempt in range(1, max_attempts + 1):
+        if attempt > 1:
+            logging.info("Retrying failed API requests")
+            time.sleep(controller.retry_delay(attempt, retry_response))
+
+        # gevent pools cannot be resized mid-flight, so the limit is applied per round
+        rs = [grequests.get(url) for url in remaining]
+        failed = []
+        # The round is retried together, so wait as long as the longest Retry-After asks
+        retry_response = None
+        for index, response in grequests.imap_enumerated(rs, size=controller.current_limit):
+            url = remaining[index]
+            if response is not None and response.status_code == 200:
+                controller.record_success(response.elapsed.total_seconds())
+                yield url, response
+            elif is_retryable(response) and attempt < max_attempts:
+                controller.record_failure()
+                status = response.status_code if response is not None else "no response"
+                logging.error(f"Error {status} for {url}. Will retry.")
+                failed.append(url)
+                retry_after = controller.parse_retry_after(response)
+                if retry_after is not None and retry_after > (controller.parse_retry_after(retry_response) or -1):
+                    retry_response = response
+            else:
+                yield url, response
+        remaining = failed
+        if not remaining:
+            break
+
+def fetch_package_metadata(resource, etag=None, last_modified=None):
+    """
+    Fetches package_show metadata for a dataset, as a conditional request when validators from a
+    previous response are given. Returns (metadata, validators); metadata is None if unchanged.
+    """
+    import requests
+    config = get_config()
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    response = requests.get(f"{config.base_endpoint}{config.package_show_method}{resource}", headers=headers)
+    validators = {"etag": response.headers.get('ETag', etag), "last_modified": response.headers.get('Last-Modified', last_modified)}
+    if response.status_code == 304:
+        return None, validators
+    response.raise_for_status()  # Ensure the request was successful
+    return response.json(), validators
+
+def latest_resource_month(metadata_response):
+    # Latest 'YYYY-MM' in the resource table names, without building a DataFrame
+    import re
+    months = [
+        re.search(r'(\d{4})(\d{2})', resource.get('bq_table_name') or '')
+        for resource in metadata_response['result']['resources']
+    ]
+    months = [f"{match.group(1)}-{match.group(2)}" for match in months if match]
+    return max(months) if months else None
+
+class MonthIndex:
+    """
+    Sorted month -> table index over one package_show snapshot, so dates and ranges resolve by
+    binary search instead of filtering the resources table.
+    """
+    def __init__(self, resources, metadata_fields=()):
+        import re
+        entries = []
+        for resource in resources:
+            match = re.search(r'(\d{6})', resource.get('bq_table_name') or '')
+            if match and self.validate_month(match.group(1)):
+                metadata = {field: str(resource[field]) for field in metadata_fields if resource.get(field) is not None}
+                entries.append((int(match.group(1)), resource['bq_table_name'], metadata))
+        entries.sort(key=lambda entry: entry[0])
+        # Parallel lists, one item per table, ordered by month
+        self.keys = [entry[0] for entry in entries]
+        self.table_names = [entry[1] for entry in entries]
+        self.metadata = [entry[2] for entry in entries]
+        # Distinct months, for earliest+n / latest-n
+        self.months = sorted(set(self.keys))
+
+    @staticmethod
+    def validate_month(month):
+        return len(month) == 6 and 1 <= int(month[4:]) <= 12
+
+    @staticmethod
+    def to_timestamp(key):
+        import pandas as pd
+        return pd.Timestamp(year=key // 100, month=key % 100, day=1)
+
+    def nth(self, date_type, n, ascending=True):
+        if not self.months:
+            raise ValueError(f"No months are available for '{date_type}{n}'.")
+        if n < len(self.months):
+            return self.months[n] if ascending else self.months[-1 - n]
+        raise ValueError(f"The value '{date_type}{n}' is out of range. Maximum allowable is '{date_type}{len(self.months) - 1}'.")
+
+    def resolve(self, date, date_type="from"):
+        """
+        Resolves 'earliest', 'latest', 'earliest+n', 'latest-n', 'YYYYMM' or '' to a YYYYMM integer.
+        """
+        if date == "earliest" or (date == "" and date_type == "from"):
+            return self.nth("earliest", 0)
+        if date == "latest" or (date == "" and date_type == "to"):
+            return self.nth("latest", 0, ascending=False)
+        for prefix, separator, ascending in (("latest-", '-', False), ("earliest+", '+', True)):
+            if date.startswith(prefix):
+                try:
+                    n = int(date.split(separator)[1])
+                    if n > 0:
+                        return self.nth(prefix, n, ascending=ascending)
+                    raise ValueError(f"The value after '{prefix}' must be a positive integer.")
+                except ValueError as e:
+                    raise ValueError(f"Invalid format for '{prefix}n'. Expected '{prefix}1', '{prefix}2', etc.") from e
+        if date.isdigit() and self.validate_month(date):
+            return int(date)
+        raise ValueError(
+            "Unexpected date format. Expected one of the following: 'YYYYMM', 'earliest', 'latest', 'latest-n', or 'earliest+n' "
+            "(e.g., 'latest-1', 'earliest+1')."
+        )
+
+    def range_positions(self, key_from, key_to):
+        # Positions of the tables from key_from to key_to inclusive, by binary search
+        return range(bisect.bisect_left(self.keys, key_from), bisect.bisect_right(self.keys, key_to))
+
+    def spec_positions(self, spec):
+        # A month ('202401', 'latest-2'), a year ('2024'), a quarter ('2024Q1') or a range ('202401:latest')
+        spec = str(spec).strip()
+        if ':' in spec:
+            date_from, date_to = spec.split(':', 1)
+            return self.range_positions(self.resolve(date_from, "from"), self.resolve(date_to, "to"))
+        if len(spec) == 4 and spec.isdigit():
+            return self.range_positions(int(spec) * 100 + 1, int(spec) * 100 + 12)
+        if len(spec) == 6 and spec[:4].isdigit() and spec[4].upper() == 'Q' and spec[5] in "1234":
+            first_month = int(spec[:4]) * 100 + (int(spec[5]) - 1) * 3 + 1
+            return self.range_positions(first_month, first_month + 2)
+        key = self.resolve(spec)
+        return self.range_positions(key, key)
+
+    def select(self, months):
+        """
+        Positions of the tables matching any of the given month specs, in month order.
+        """
+        if isinstance(months, str):
+            months = months.split(',')
+        positions = set()
+        for spec in months:
+            positions.update(self.spec_positions(spec))
+        return sorted(positions)
+
+_MONTH_INDEXES = {}
+
+def get_month_index(metadata_response):
+    # One index per metadata snapshot, shared by every ResourceNames built from it
+    metadata_fields = tuple(get_config().cache_metadata_fields)
+    resources = metadata_response['result']['resources']
+    snapshot = json.dumps([resources, metadata_fields], sort_keys=True, default=str)
+    with _SHARED_OBJ_LOCK:
+        if snapshot not in _MONTH_INDEXES:
+            _MONTH_INDEXES[snapshot] = MonthIndex(resources, metadata_fields)
+        return _MONTH_INDEXES[snapshot]
 
 class ResourceNames:
     """
     Handles fetching and filtering resource names based on date ranges.
     """
-    def __init__(self, resource, date_from, date_to):
+    def __init__(self, resource, date_from, date_to, metadata_response=None, months=None):
         self.resource = resource
-        self.resources_table = None
+        self.month_index = None
         self.resource_from = None
         self.resource_to = None
 
-        self.get_resource_names()
-        self.resource_from = self.set_date(date_from, date_type="from")
-        self.resource_to = self.set_date(date_to, date_type="to")
-        self.resource_name_list_filter()
-
-    def get_resource_names(self):
-        response = requests.get(f"{CONFIG_OBJ.base_endpoint}{CONFIG_OBJ.package_show_method}{self.resource}")
-        response.raise_for_status()  # Ensure the request was successful
-        metadata_response = response.json()
-        self.resources_table = pd.json_normalize(metadata_response['result']['resources'])
-        self.resources_table['date'] = pd.to_datetime(
-            self.resources_table['bq_table_name'].str.extract(r'(\d{6})')[0], format='%Y%m', errors='coerce'
-        )
+        # Metadata already fetched (e.g. by a poller) can be passed in to save a request
+        self.get_resource_names(metadata_response)
+        if months is not None:
+            # An arbitrary set of months (lists, gaps, years, quarters) rather than one range
+            positions = self.month_index.select(months)
+            if not positions:
+                raise ValueError(f"No {resource} tables match the months '{months}'.")
+            # The span of the selection, for return_resources_from/to
+            self.resource_from = self.month_index.to_timestamp(self.month_index.keys[positions[0]])
+            self.resource_to = self.month_index.to_timestamp(self.month_index.keys[positions[-1]])
+        else:
+            key_from = self.month_index.resolve(date_from, "from")
+            key_to = self.month_index.resolve(date_to, "to")
+            positions = self.month_index.range_positions(key_from, key_to)
+            self.resource_from = self.month_index.to_timestamp(key_from)
+            self.resource_to = self.month_index.to_timestamp(key_to)
+        self.resource_name_list_filter(positions)
+
+    def get_resource_names(self, metadata_response=None):
+        if metadata_response is None:
+            metadata_response, _ = fetch_package_metadata(self.resource)
+        self.month_index = get_month_index(metadata_response)
 
     @staticmethod
     def validate_date(date_str):
@@ -114,52 +615,25 @@ class ResourceNames:
         return date.strftime("%Y-%m-%d")
 
     def get_nth_date(self, date_type, n, ascending=True):
-        sorted_dates = self.resources_table['date'].sort_values(ascending=ascending).unique()
-        if n < len(sorted_dates):
-            return sorted_dates[n]
-        max_val = len(sorted_dates) - 1
-        raise ValueError(f"The value '{date_type}{n}' is out of range. Maximum allowable is '{date_type}{max_val}'.")
+        return self.month_index.to_timestamp(self.month_index.nth(date_type, n, ascending))
 
     def set_date(self, date, date_type):
-        if date == "earliest":
-            return self.resources_table['date'].min()
-        if date == "latest":
-            return self.resources_table['date'].max()
-        if date.startswith("latest-"):
-            try:
-                n = int(date.split('-')[1])
-                if n > 0:
-                    return self.get_nth_date('latest-', n, ascending=False)
-                raise ValueError("The value after 'latest-' must be a positive integer.")
-            except ValueError as e:
-                raise ValueError("Invalid format for 'latest-n'. Expected 'latest-1', 'latest-2', etc.") from e
-        if date.startswith("earliest+"):
-            try:
-                n = int(date.split('+')[1])
-                if n > 0:
-                    return self.get_nth_date('earliest+', n, ascending=True)
-                raise ValueError("The value after 'earliest+' must be a positive integer.")
-            except ValueError as e:
-                raise ValueError("Invalid format for 'earliest+n'. Expected 'earliest+1', 'earliest+2', etc.") from e
-        if date == "" and date_type == "from":
-            return self.resources_table['date'].min()
-        if date == "" and date_type == "to":
-            return self.resources_table['date'].max()
-        if self.validate_date(date):
-            return self.convert_YYMM_to_date(date)
-        raise ValueError(
-            "Unexpected date format. Expected one of the following: 'YYYYMM', 'earliest', 'latest', 'latest-n', or 'earliest+n' "
-            "(e.g., 'latest-1', 'earliest+1')."
-        )
+        # Always a Timestamp, whichever form the date was given in
+        return self.month_index.to_timestamp(self.month_index.resolve(date, date_type))
 
-    def resource_name_list_filter(self):
-        filtered_df = self.resources_table[
-            (self.resources_table['date'] >= self.resource_from) & 
-            (self.resources_table['date'] <= self.resource_to)
-        ]
-        
-        self.resource_name_list = filtered_df['bq_table_name'].tolist()
-        self.date_list = filtered_df['date'].tolist()
+    def resource_name_list_filter(self, positions):
+        index = self.month_index
+        self.resource_name_list = [index.table_names[i] for i in positions]
+        self.date_list = [index.to_timestamp(index.keys[i]) for i in positions]
+        if self.date_list and self.resource_from is None:
+            self.resource_from = self.date_list[0]
+            self.resource_to = self.date_list[-1]
+
+        # Metadata for each table so cached months can be revalidated
+        self.resource_metadata = {index.table_names[i]: index.metadata[i] for i in positions}
+
+    def return_resource_metadata(self, resource_name):
+        return self.resource_metadata.get(resource_name)
 
     def return_date_list(self):
         return self.date_list
@@ -170,14 +644,37 @@ class ResourceNames:
     def return_resources_to(self):
         return self.resource_to
 
+def json_loads(payload):
+    # orjson parses several times faster than json when it is installed
+    try:
+        import orjson
+        return orjson.loads(payload)
+    except ImportError:
+        return json.loads(payload)
+
+def records_to_frame(result):
+    """
+    Builds a DataFrame from a datastore_search_sql result one column at a time, which is much
+    faster than json_normalize for flat records.
+    """
+    import pandas as pd
+    records = result['records']
+    if records:
+        fields = list(records[0])
+    else:
+        fields = [field['id'] for field in result.get('fields', [])]
+    columns = {field: [record.get(field) for record in records] for field in fields}
+    return pd.DataFrame(columns, columns=fields)
+
 class APICall:
     """
     Represents a single API call with caching capabilities.
     """
-    def __init__(self, resource_id, sql, cache=False):
+    def __init__(self, resource_id, sql, cache=False, resource_metadata=None):
         self.resource_id = resource_id
         self.sql = sql
         self.cache = cache
+        self.resource_metadata = resource_metadata
         self.api_url = None
         self.cache_data = None
         self.set_table_name()
@@ -191,75 +688,118 @@ class APICall:
         self.sql = self.sql.replace(placeholder, f"FROM `{self.resource_id}`")
 
     def generate_url(self):
+        config = get_config()
         self.api_url = (
-            f"{CONFIG_OBJ.base_endpoint}{CONFIG_OBJ.action_method}"
+            f"{config.base_endpoint}{config.action_method}"
             f"resource_id={self.resource_id}&"
             f"sql={urllib.parse.quote(self.sql)}"
         )
     
     def collect_cache_data(self):
         if self.cache:
-            self.cache_data = CACHE_MANAGER_OBJ.check_cache(self.api_url)
+            self.cache_data = get_cache_manager().check_cache(self.api_url, self.resource_metadata, raw=True)
 
 class FetchData:
     """
     Orchestrates the fetching of data from the API, including handling
     of cache, API calls, and data processing.
     """
-    def __init__(self, resource, sql, date_from, date_to, cache=False, max_attempts = 3):
+    def __init__(self, resource, sql, date_from, date_to, cache=False, max_attempts = 3, backend=None, resume=True, controller=None,
+                 categories=None, months=None, metadata_response=None, fetch=True):
+        configure_runtime()
         print (f"Fetching data please wait...")
         self.resource = resource
         self.sql = sql
         self.cache = cache
         self.max_attempts = max_attempts
-        self.resource_names_obj = ResourceNames(resource, date_from, date_to)
+        self.backend = backend
+        self.controller = controller or get_concurrency_controller()
+        self.resume = resume
+        # Optional CategoryRegistry - text columns are returned as categoricals sharing its categories
+        self.categories = categories
+        # months, if given, selects an arbitrary set of months instead of date_from to date_to
+        self.resource_names_obj = ResourceNames(resource, date_from, date_to, metadata_response=metadata_response, months=months)
+        self.manifest = JobManifest(get_config().MANIFEST_DIR, resource, sql, self.resource_names_obj.resource_name_list)
         self.api_calls_list = []
         self.returned_json_list = []
+        self.returned_resource_list = []
         self.requests_map = []
         self.resource_list = []
+        self.metadata_map = {}
+        self.resource_id_map = {}
+        self.incomplete_months = []
+        self.resource_dates = {}
+        self.month_results = {}
         self.full_results_df = None
+        self.start_manifest()
         self.generate_api_calls()
         self.generate_request_map()
-        self.request_data()
+        # A FetchSession prepares several pulls without fetching and then requests them together
+        if fetch:
+            self.request_data()
+            self.finish()
+
+    def finish(self):
         self.process_data()
         print (f"Data retrieved.")
 
+    def start_manifest(self):
+        dates = [date.strftime('%Y-%m') for date in self.resource_names_obj.return_date_list()]
+        self.resource_dates = dict(zip(self.resource_names_obj.resource_name_list, dates))
+        self.manifest.start(self.resource_names_obj.resource_name_list, dates)
+
     def generate_api_calls(self):
         for resource_id in self.resource_names_obj.resource_name_list:
-            self.api_calls_list.append(APICall(resource_id, self.sql, self.cache))
+            resource_metadata = self.resource_names_obj.return_resource_metadata(resource_id)
+            self.api_calls_list.append(APICall(resource_id, self.sql, self.cache, resource_metadata))
 
     def generate_request_map(self):
         for api_call in self.api_calls_list:
+            if not api_call.cache_data and self.resume and self.manifest.is_resumable(api_call.resource_id):
+                # Fetched by an earlier, interrupted run of this job - pick it up from the cache
+                api_call.cache_data = get_cache_manager().check_cache(api_call.api_url, api_call.resource_metadata, raw=True)
             if api_call.cache_data:
                 self.returned_json_list.append(api_call.cache_data)
+                self.returned_resource_list.append(api_call.resource_id)
+                if self.manifest.status(api_call.resource_id) != JobManifest.NORMALISED:
+                    self.manifest.set_status(api_call.resource_id, JobManifest.FETCHED)
             else:
                 self.requests_map.append(api_call.api_url)
                 self.resource_list.append(api_call.resource_id)
+                self.metadata_map[api_call.api_url] = api_call.resource_metadata
+                self.resource_id_map[api_call.api_url] = api_call.resource_id
 
     def request_data(self):
-        retry_counter = 1
-        while self.requests_map and retry_counter <= self.max_attempts:
-            if retry_counter > 1:
-                logging.info("Retrying failed API requests")
-                time.sleep(2 ** retry_counter)  # Exponential backoff
-            
-            rs = [grequests.get(url) for url in self.requests_map]
-            for response in grequests.imap(rs, size=5):
-                if response.status_code == 200:
-                    self.returned_json_list.append(response.json())
-                    CACHE_MANAGER_OBJ.save_to_cache(response.url, response.json())
-                    self.requests_map.remove(response.url)
-                    logging.info(f"Success for {response.url}")
-                else:
-                    logging.error(f"Error {response.status_code} for {response.url}. Will retry.")
-                    #raise requests.HTTPError(response.status_code, response.url)
-
-            retry_counter += 1
+        for api_url, response in iter_responses(list(self.requests_map), self.max_attempts, self.controller, self.backend):
+            self.record_response(api_url, response)
+        logging.info(f"API concurrency: {self.controller.stats()}")
+
+    def record_response(self, api_url, response, save=True):
+        resource_id = self.resource_id_map[api_url]
+        if response is not None and response.status_code == 200:
+            # Kept as bytes - parsed once in process_data and cached without re-serialising
+            self.returned_json_list.append(response.content)
+            self.returned_resource_list.append(resource_id)
+            if save:
+                get_cache_manager().save_to_cache(api_url, response.content, self.metadata_map.get(api_url))
+            self.manifest.set_status(resource_id, JobManifest.FETCHED)
+            self.requests_map.remove(api_url)
+            logging.info(f"Success for {api_url}")
+        else:
+            error = f"HTTP {response.status_code}" if response is not None else "no response"
+            self.manifest.set_status(resource_id, JobManifest.FAILED, error)
+            logging.error(f"Giving up on {api_url} after {self.max_attempts} attempts ({error})")
 
     def process_data(self):
-        dataframes = []
+        import requests
+        import pandas as pd
         logging.info("Processing response data")
-        for idx, response_json in enumerate(self.returned_json_list):
+        # Process months in date order so results do not depend on the order responses arrived
+        responses = sorted(zip(self.returned_resource_list, self.returned_json_list), key=lambda item: self.resource_dates[item[0]])
+        # A month can be published as more than one table, so frames are kept per table
+        frames = []
+        for resource_id, payload in responses:
+            response_json = json_loads(payload)
             if 'records_truncated' in response_json['result'] and response_json['result']['records_truncated'] == 'true':
                 download_url = response_json['result']['gc_urls'][0]['url']
                 logging.info(f"Downloading truncated data from URL: {download_url}")
@@ -267,16 +807,49 @@ class FetchData:
                 with gzip.open(io.BytesIO(r.content), 'rt') as f:
                     tmp_df = pd.read_csv(f)
             else:
-                tmp_df = pd.json_normalize(response_json['result']['result']['records'])
-            dataframes.append(tmp_df)
+                tmp_df = records_to_frame(response_json['result']['result'])
+            del response_json
+            if self.categories is not None:
+                tmp_df = self.categories.encode(tmp_df)
+            frames.append((self.resource_dates[resource_id], tmp_df))
+            self.manifest.set_status(resource_id, JobManifest.NORMALISED)
+        # The raw responses are no longer needed once every month is a DataFrame
+        self.returned_json_list = []
 
-        self.full_results_df = pd.concat(dataframes, ignore_index=True)
+        if self.categories is not None:
+            # Later months may have added categories, bring every month up to the full set
+            frames = [(month, self.categories.align(df)) for month, df in frames]
+        month_frames = {}
+        for month, df in frames:
+            month_frames.setdefault(month, []).append(df)
+        self.month_results = {
+            month: dfs[0] if len(dfs) == 1 else pd.concat(dfs, ignore_index=True) for month, dfs in month_frames.items()
+        }
+        dataframes = [df for _, df in frames]
+        self.full_results_df = pd.concat(dataframes, ignore_index=True) if dataframes else pd.DataFrame()
+        self.report_incomplete_months()
         logging.info("Data processing complete")
+
+    def report_incomplete_months(self):
+        self.incomplete_months = self.manifest.incomplete_months(self.resource_names_obj.resource_name_list)
+        if self.incomplete_months:
+            print (f"Warning: data missing for {len(self.incomplete_months)} month(s): {', '.join(self.incomplete_months)}. "
+                   "Run again to resume the pull.")
+        else:
+            self.manifest.mark_complete()
+
+    def return_incomplete_months(self):
+        return self.incomplete_months
         
     def results(self):
         return self.full_results_df
+
+    def results_by_month(self):
+        # Results for each month keyed by 'YYYY-MM', in date order
+        return dict(sorted(self.month_results.items()))
     
     def return_resources_from(self):
+        import pandas as pd
         # Given Timestamp
         timestamp = pd.Timestamp(self.resource_names_obj.return_resources_from())
 
@@ -286,6 +859,7 @@ class FetchData:
         return formatted_string
     
     def return_resources_to(self):
+        import pandas as pd
         # Given Timestamp
         timestamp = pd.Timestamp(self.resource_names_obj.return_resources_to())
 
@@ -294,9 +868,85 @@ class FetchData:
 
         return formatted_string
 
+class FetchSession:
+    """
+    Fetches several queries - each a dataset, SQL and months - together rather than one after
+    another. Package metadata is fetched once per dataset, every month of every query goes through
+    one connection pool and concurrency limit, and the results share one CategoryRegistry so the
+    frames for different datasets can be joined on their codes.
+
+        session = FetchSession(cache=True)
+        session.add("epd", "english-prescribing-data-epd", sql, "latest-2", "latest")
+        session.add("other", "another-dataset", other_sql, "latest-2", "latest")
+        frames = session.run()  # {"epd": DataFrame, "other": DataFrame}
+    """
+    def __init__(self, cache=False, max_attempts=3, backend=None, resume=True, controller=None, categories=None):
+        self.cache = cache
+        self.max_attempts = max_attempts
+        self.backend = backend
+        self.resume = resume
+        self.controller = controller or get_concurrency_controller()
+        self.categories = categories if categories is not None else CategoryRegistry()
+        self.queries = {}
+        self.fetches = {}
+        self.metadata = {}
+
+    def add(self, name, resource, sql, date_from="earliest", date_to="latest", months=None):
+        if name in self.queries:
+            raise ValueError(f"A query named '{name}' has already been added to this session.")
+        self.queries[name] = {"resource": resource, "sql": sql, "date_from": date_from, "date_to": date_to, "months": months}
+        return self
+
+    def package_metadata(self, resource):
+        if resource not in self.metadata:
+            self.metadata[resource], _ = fetch_package_metadata(resource)
+        return self.metadata[resource]
+
+    def run(self):
+        """
+        Fetches every query and returns {name: DataFrame} in the order the queries were added.
+        """
+        for name, query in self.queries.items():
+            self.fetches[name] = FetchData(
+                resource=query["resource"], sql=query["sql"], date_from=query["date_from"], date_to=query["date_to"],
+                cache=self.cache, max_attempts=self.max_attempts, backend=self.backend, resume=self.resume,
+                controller=self.controller, categories=self.categories, months=query["months"],
+                metadata_response=self.package_metadata(query["resource"]), fetch=False
+            )
+
+        # Queries asking for the same table with the same SQL share one request
+        owners = {}
+        for fetch in self.fetches.values():
+            for api_url in fetch.requests_map:
+                owners.setdefault(api_url, []).append(fetch)
+        for api_url, response in iter_responses(list(owners), self.max_attempts, self.controller, self.backend):
+            for i, fetch in enumerate(owners[api_url]):
+                fetch.record_response(api_url, response, save=i == 0)
+        logging.info(f"API concurrency: {self.controller.stats()}")
+
+        for fetch in self.fetches.values():
+            fetch.finish()
+        return self.results()
+
+    def results(self):
+        # Later queries may have added categories, so bring every frame up to the full set
+        return {name: self.categories.align(fetch.results()) for name, fetch in self.fetches.items()}
+
+    def results_by_month(self):
+        # {name: {'YYYY-MM': DataFrame}} with every frame on the session's full categories
+        return {
+            name: {month: self.categories.align(df) for month, df in fetch.results_by_month().items()}
+            for name, fetch in self.fetches.items()
+        }
+
+    def return_incomplete_months(self):
+        return {name: fetch.return_incomplete_months() for name, fetch in self.fetches.items() if fetch.return_incomplete_months()}
+
 def show_available_datasets():
+    import requests
+    config = get_config()
     # Extract list of datasets
-    datasets_response = requests.get(CONFIG_OBJ.base_endpoint +  CONFIG_OBJ.package_list_method).json()
+    datasets_response = requests.get(config.base_endpoint +  config.package_list_method).json()
     
     # Get as a list
     dataset_list=datasets_response['result']
@@ -307,4 +957,5 @@ def show_available_datasets():
     
     # Print available datasets
     for item in filtered_list:
-        print (item)
\ No newline at end of file
+        print (item)
+    return filtered_list
\ No newline at end of file
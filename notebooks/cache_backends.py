@@ -0,0 +1,178 @@
+import os
+import json
+import hashlib
+import sqlite3
+import urllib.parse
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows - fall back to locking between threads only
+    fcntl = None
+
+# Cache backends store the response payload as bytes with a small metadata dict, keyed by API URL.
+# get(api_url) returns (payload, metadata) or None, put(api_url, payload, metadata) stores or replaces
+# an entry and set_metadata(api_url, metadata) updates the metadata of an existing entry.
+
+@contextmanager
+def file_lock(lock_file):
+    # Exclusive lock held across processes (and hosts, on file systems that support flock)
+    os.makedirs(os.path.dirname(lock_file) or ".", exist_ok=True)
+    with open(lock_file, 'a') as f:
+        if fcntl:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+class LocalCacheBackend:
+    """
+    Response files in a directory with a JSON mapping from API URL to file and metadata.
+    Compatible with caches written by earlier versions.
+    """
+    def __init__(self, cache_dir, cache_mapping_file=None):
+        self.cache_dir = cache_dir
+        self.cache_mapping_file = cache_mapping_file or os.path.join(cache_dir, "cache_mapping.json")
+        self.lock_file = f"{self.cache_mapping_file}.lock"
+
+    def load_cache_mapping(self):
+        if os.path.exists(self.cache_mapping_file):
+            with open(self.cache_mapping_file, 'r') as f:
+                return json.load(f)
+        return {}
+
+    def save_cache_mapping(self, cache_mapping):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # Replace the mapping in one step so another process never reads a half-written file
+        tmp_file = f"{self.cache_mapping_file}.{os.getpid()}.tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(cache_mapping, f, indent=4)
+        os.replace(tmp_file, self.cache_mapping_file)
+
+    @staticmethod
+    def get_cache_entry(cache_mapping, api_url):
+        entry = cache_mapping.get(api_url)
+        # Older mappings stored just the file path
+        if isinstance(entry, str):
+            entry = {"file": entry, "metadata": None}
+        return entry
+
+    def get(self, api_url):
+        entry = self.get_cache_entry(self.load_cache_mapping(), api_url)
+        if entry and os.path.exists(entry["file"]):
+            with open(entry["file"], 'rb') as f:
+                return f.read(), entry["metadata"]
+        return None
+
+    def put(self, api_url, payload, metadata=None):
+        with file_lock(self.lock_file):
+            cache_mapping = self.load_cache_mapping()
+            entry = self.get_cache_entry(cache_mapping, api_url)
+            if entry:
+                # Overwrite the existing file when refreshing a stale entry
+                cache_file = entry["file"]
+            else:
+                # Named after the URL so two processes can never pick the same file for different requests
+                cache_file = os.path.join(self.cache_dir, f"cache_{hashlib.sha1(api_url.encode()).hexdigest()[:16]}.json")
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+            with open(tmp_file, 'wb') as f:
+                f.write(payload)
+            os.replace(tmp_file, cache_file)
+            cache_mapping[api_url] = {"file": cache_file, "metadata": metadata}
+            self.save_cache_mapping(cache_mapping)
+
+    def set_metadata(self, api_url, metadata):
+        with file_lock(self.lock_file):
+            cache_mapping = self.load_cache_mapping()
+            entry = self.get_cache_entry(cache_mapping, api_url)
+            if entry:
+                cache_mapping[api_url] = {"file": entry["file"], "metadata": metadata}
+                self.save_cache_mapping(cache_mapping)
+
+class SQLiteCacheBackend:
+    """
+    All responses in one SQLite file, which can be shared by several kernels or runners.
+    SQLite serialises concurrent writers itself.
+    """
+    def __init__(self, db_file):
+        self.db_file = db_file
+        os.makedirs(os.path.dirname(db_file) or ".", exist_ok=True)
+        with self.connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache (api_url TEXT PRIMARY KEY, metadata TEXT, payload BLOB NOT NULL)"
+            )
+
+    @contextmanager
+    def connect(self):
+        # A connection per call, as connections cannot be shared between threads
+        connection = sqlite3.connect(self.db_file, timeout=60)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def get(self, api_url):
+        with self.connect() as connection:
+            row = connection.execute("SELECT payload, metadata FROM cache WHERE api_url = ?", (api_url,)).fetchone()
+        if row is None:
+            return None
+        return bytes(row[0]), json.loads(row[1]) if row[1] else None
+
+    def put(self, api_url, payload, metadata=None):
+        with self.connect() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO cache (api_url, metadata, payload) VALUES (?, ?, ?)",
+                (api_url, json.dumps(metadata) if metadata is not None else None, sqlite3.Binary(payload))
+            )
+
+    def set_metadata(self, api_url, metadata):
+        with self.connect() as connection:
+            connection.execute("UPDATE cache SET metadata = ? WHERE api_url = ?", (json.dumps(metadata), api_url))
+
+class HTTPCacheBackend:
+    """
+    A key-value server shared by every host, e.g. cache_server.py. Each entry is stored under
+    {base_url}/{sha256 of the API URL} with the metadata in the X-Cache-Metadata header.
+    """
+    def __init__(self, base_url, timeout=60):
+        import requests
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def entry_url(self, api_url):
+        return f"{self.base_url}/{hashlib.sha256(api_url.encode()).hexdigest()}"
+
+    def get(self, api_url):
+        response = self.session.get(self.entry_url(api_url), timeout=self.timeout)
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        metadata = response.headers.get('X-Cache-Metadata')
+        return response.content, json.loads(metadata) if metadata else None
+
+    def put(self, api_url, payload, metadata=None):
+        headers = {'Content-Type': 'application/json', 'X-Cache-Metadata': json.dumps(metadata)}
+        self.session.put(self.entry_url(api_url), data=payload, headers=headers, timeout=self.timeout).raise_for_status()
+
+    def set_metadata(self, api_url, metadata):
+        entry = self.get(api_url)
+        if entry is not None:
+            self.put(api_url, entry[0], metadata)
+
+def make_cache_backend(spec, cache_dir, cache_mapping_file=None):
+    """
+    Backend for a BSA_CACHE_BACKEND setting: "local" (default), "sqlite:<path>" or an http(s) URL.
+    """
+    if not spec or spec == "local":
+        return LocalCacheBackend(cache_dir, cache_mapping_file)
+    if spec.startswith("sqlite:"):
+        return SQLiteCacheBackend(spec[len("sqlite:"):] or os.path.join(cache_dir, "cache.sqlite"))
+    if urllib.parse.urlparse(spec).scheme in ("http", "https"):
+        return HTTPCacheBackend(spec)
+    raise ValueError(f"Unknown cache backend '{spec}'. Expected 'local', 'sqlite:<path>' or an http(s) URL.")
@@ -0,0 +1,52 @@
+import os
+import json
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from cache_backends import SQLiteCacheBackend
+
+# A minimal key-value server for HTTPCacheBackend, storing entries in SQLite. Run it on a shared
+# host (or locally to try the shared cache) and set BSA_CACHE_BACKEND=http://<host>:<port>/cache
+
+class CacheRequestHandler(BaseHTTPRequestHandler):
+    store = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def entry_key(self):
+        return self.path.rstrip('/').split('/')[-1]
+
+    def do_GET(self):
+        entry = self.store.get(self.entry_key())
+        if entry is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+        payload, metadata = entry
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.send_header('X-Cache-Metadata', json.dumps(metadata))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_PUT(self):
+        payload = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        metadata = self.headers.get('X-Cache-Metadata')
+        self.store.put(self.entry_key(), payload, json.loads(metadata) if metadata else None)
+        self.send_response(204)
+        self.end_headers()
+
+def make_server(host="127.0.0.1", port=8765, db_file=os.path.join("..", "data", "cache_server.sqlite")):
+    handler = type("Handler", (CacheRequestHandler,), {"store": SQLiteCacheBackend(db_file)})
+    return ThreadingHTTPServer((host, port), handler)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a shared response cache for bsa_utils.")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8765, help="Port to listen on (default: 8765)")
+    parser.add_argument("--db", default=os.path.join("..", "data", "cache_server.sqlite"), help="SQLite file for the cache")
+    args = parser.parse_args()
+    server = make_server(args.host, args.port, args.db)
+    print(f"Serving cache on http://{args.host}:{server.server_port}/cache")
+    server.serve_forever()
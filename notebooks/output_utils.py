@@ -0,0 +1,161 @@
+import os
+import glob
+import pandas as pd
+from cache_backends import file_lock
+
+OUTPUT_DIR = os.path.join("..", "reports", "data")
+
+# Tables written by the new item report and the testing report
+NEW_ITEM_TABLES = ["new_chem_subs", "new_bnf_codes", "new_descriptions", "similar_descriptions"]
+TESTING_TABLES = ["measure_results", "measure_matches", "measure_definition_changes"]
+
+# Month x BNF chapter and section counts, kept up to date as each month's tables are written
+SUMMARY_CUBE_FILE = os.path.join(OUTPUT_DIR, "summary_cube.parquet")
+# Kept with the working data rather than in the published reports
+SUMMARY_CUBE_LOCK_FILE = os.path.join("..", "data", "summary_cube.lock")
+# Monthly table -> (count column, column whose distinct values are counted)
+SUMMARY_COUNTS = {
+    "new_bnf_codes": ("NEW_BNF_CODES", "BNF_CODE"),
+    "new_descriptions": ("NEW_DESCRIPTIONS", "BNF_DESCRIPTION"),
+    "new_chem_subs": ("NEW_CHEM_SUBS", "CHEMICAL_SUBSTANCE_BNF_DESCR"),
+    "measure_matches": ("MEASURE_TRIGGERS", "MEASURE"),
+}
+SUMMARY_KEYS = ["REPORT_MONTH", "BNF_CHAPTER", "BNF_SECTION"]
+# Key value of the rows totalling a whole chapter or month. Counts are of distinct values, so a
+# measure matching codes in two sections counts once in its chapter and month rows
+SUMMARY_ALL = "ALL"
+
+def month_path(table, date, extension):
+    return os.path.join(OUTPUT_DIR, table, f"{table}_{date}.{extension}")
+
+def write_month_outputs(date, tables):
+    """
+    Writes each table for a report month as Parquet and as JSON lines, with a REPORT_MONTH column
+    so that months can be combined. Re-running a month replaces its files.
+    """
+    for table, df in tables.items():
+        if df is None:
+            continue
+        df = df.reset_index(drop=True)
+        # Categoricals from a shared registry carry every value ever seen, which Parquet would
+        # write into each file's dictionary - the published files hold plain values
+        df = df.astype({c: object for c in df.columns if isinstance(df[c].dtype, pd.CategoricalDtype)})
+        df.insert(0, "REPORT_MONTH", date)
+        os.makedirs(os.path.dirname(month_path(table, date, "parquet")), exist_ok=True)
+        # Written aside and moved into place, as the other report may be recounting this month
+        for extension, write in (("parquet", lambda f: df.to_parquet(f, index=False)),
+                                 ("jsonl", lambda f: df.to_json(f, orient="records", lines=True))):
+            tmp_file = f"{month_path(table, date, extension)}.{os.getpid()}.tmp"
+            write(tmp_file)
+            os.replace(tmp_file, month_path(table, date, extension))
+    if any(table in SUMMARY_COUNTS for table in tables):
+        update_summary_cube(date)
+
+def build_rollup(table):
+    # All months of a table in one file, rebuilt from the monthly files so backfills and re-runs stay consistent
+    files = sorted(glob.glob(month_path(table, "*", "parquet")))
+    if not files:
+        return None
+    # Categorical columns from different months have different categories, so combine them as text
+    frames = [pd.read_parquet(f) for f in files]
+    frames = [df.astype({c: object for c in df.columns if isinstance(df[c].dtype, pd.CategoricalDtype)}) for df in frames]
+    rollup = pd.concat([df for df in frames if not df.empty] or frames[:1], ignore_index=True)
+    rollup.to_parquet(os.path.join(OUTPUT_DIR, f"{table}.parquet"), index=False)
+    return rollup
+
+def build_rollups(tables):
+    for table in tables:
+        build_rollup(table)
+
+def load_rollup(table):
+    """
+    Every month of a report table, e.g. load_rollup("new_bnf_codes").
+    """
+    return pd.read_parquet(os.path.join(OUTPUT_DIR, f"{table}.parquet"))
+
+def month_summary(date):
+    # Counts for one month from its table files: a row per section with anything new, and the
+    # chapter and month totals, each counted over distinct values rather than summed. The month
+    # total is always written, as zeros for a month with nothing new, so quiet months are kept
+    counts = [pd.Series(0, index=pd.MultiIndex.from_tuples([(date, SUMMARY_ALL, SUMMARY_ALL)], names=SUMMARY_KEYS))]
+    for table, (count_column, value_column) in SUMMARY_COUNTS.items():
+        if not os.path.exists(month_path(table, date, "parquet")):
+            continue
+        df = pd.read_parquet(month_path(table, date, "parquet"), columns=list(dict.fromkeys(["BNF_CODE", value_column])))
+        if df.empty:
+            continue
+        codes = df["BNF_CODE"].astype(str)
+        levels = [
+            df.assign(REPORT_MONTH=date, BNF_CHAPTER=codes.str[:2], BNF_SECTION=codes.str[:4]),
+            df.assign(REPORT_MONTH=date, BNF_CHAPTER=codes.str[:2], BNF_SECTION=SUMMARY_ALL),
+            df.assign(REPORT_MONTH=date, BNF_CHAPTER=SUMMARY_ALL, BNF_SECTION=SUMMARY_ALL),
+        ]
+        counts.append(pd.concat([level.groupby(SUMMARY_KEYS)[value_column].nunique() for level in levels]).rename(count_column))
+    return pd.concat(counts, axis=1).drop(columns=0).fillna(0).reset_index()
+
+def update_summary_cube(date):
+    """
+    Replaces a month's rows in the summary cube. Reports writing different tables for the same
+    month can finish in either order, so the month is recounted from all of its files each time.
+    The first update builds the cube from every month already written.
+    """
+    with file_lock(SUMMARY_CUBE_LOCK_FILE):
+        written = set(
+            os.path.basename(f).rsplit("_", 1)[1][:-len(".parquet")]
+            for table in SUMMARY_COUNTS for f in glob.glob(month_path(table, "*", "parquet"))
+        ) | {date}
+        cube = load_summary_cube() if os.path.exists(SUMMARY_CUBE_FILE) else None
+        totalled = set() if cube is None else set(cube.loc[cube["BNF_CHAPTER"] == SUMMARY_ALL, "REPORT_MONTH"].astype(str))
+        if cube is not None and written - {date} <= totalled:
+            months = [date]
+        else:
+            # Build from every month written, also when an older cube is missing month totals
+            cube = pd.DataFrame(columns=SUMMARY_KEYS)
+            months = sorted(written)
+        cube = cube.astype({key: str for key in SUMMARY_KEYS})
+        cube = pd.concat([cube[~cube["REPORT_MONTH"].isin(months)]] + [month_summary(month) for month in months], ignore_index=True)
+        count_columns = [count_column for count_column, _ in SUMMARY_COUNTS.values()]
+        cube = cube.reindex(columns=SUMMARY_KEYS + count_columns).fillna({column: 0 for column in count_columns})
+        # Small integer counts and dictionary-encoded keys keep the file to a few KB per year
+        cube = cube.sort_values(SUMMARY_KEYS).reset_index(drop=True)
+        cube = cube.astype({**{key: "category" for key in SUMMARY_KEYS}, **{column: "int32" for column in count_columns}})
+        os.makedirs(OUTPUT_DIR, exist_ok=True)
+        tmp_file = f"{SUMMARY_CUBE_FILE}.{os.getpid()}.tmp"
+        cube.to_parquet(tmp_file, index=False, compression="zstd")
+        os.replace(tmp_file, SUMMARY_CUBE_FILE)
+    return cube
+
+def load_summary_cube():
+    """
+    Month x BNF chapter and section counts of new codes, descriptions, substances and
+    triggered measures, e.g. for trend charts in a notebook. Chapter and month totals are the rows
+    with BNF_SECTION, or both keys, set to "ALL" - use these rather than summing the sections.
+    """
+    return pd.read_parquet(SUMMARY_CUBE_FILE)
+
+def summary_trend(columns=None, by=None, last_months=None):
+    """
+    Counts per month, optionally split by "BNF_CHAPTER" or "BNF_SECTION", with months that had
+    nothing new filled in as zero. Reads only the cube, so needs no API calls.
+    """
+    if not os.path.exists(SUMMARY_CUBE_FILE):
+        return pd.DataFrame()
+    cube = load_summary_cube()
+    if cube.empty:
+        return pd.DataFrame()
+    columns = columns or [count_column for count_column, _ in SUMMARY_COUNTS.values()]
+    cube = cube.astype({key: str for key in SUMMARY_KEYS})
+    months = pd.period_range(cube["REPORT_MONTH"].min(), cube["REPORT_MONTH"].max(), freq="M").strftime("%Y-%m")
+    # Each level has its own rows, so nothing is summed across sections
+    if by is None:
+        cube = cube[cube["BNF_CHAPTER"] == SUMMARY_ALL]
+        trend = cube.set_index("REPORT_MONTH")[columns].reindex(months, fill_value=0)
+    else:
+        if by == "BNF_CHAPTER":
+            cube = cube[(cube["BNF_CHAPTER"] != SUMMARY_ALL) & (cube["BNF_SECTION"] == SUMMARY_ALL)]
+        else:
+            cube = cube[cube["BNF_SECTION"] != SUMMARY_ALL]
+        trend = cube.pivot_table(index="REPORT_MONTH", columns=by, values=columns, aggfunc="sum", fill_value=0)
+        trend = trend.reindex(months, fill_value=0)
+    trend.index.name = "REPORT_MONTH"
+    return trend.tail(last_months) if last_months else trend
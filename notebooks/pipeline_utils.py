@@ -0,0 +1,112 @@
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from artifact_utils import ArtifactStore
+
+class Stage:
+    """
+    A pipeline step: calls func with its named inputs as keyword arguments and stores what it
+    returns under its output names (a tuple when there is more than one output).
+    """
+    def __init__(self, name, func, inputs=[], outputs=[], memoise=False, version=None):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        # Memoised stages are skipped when persisted outputs exist for the same input hashes and
+        # version. The version defaults to a fingerprint of func's code; pass one (e.g. from
+        # artifact_utils.code_fingerprint) to also cover the code func calls
+        self.memoise = memoise
+        self.version = version
+
+class Pipeline:
+    """
+    Runs stages as soon as their inputs are available, so independent stages run concurrently,
+    and records stage timings to report the critical path.
+    """
+    def __init__(self, stages, store=None, max_workers=4, profiler=None):
+        self.stages = {stage.name: stage for stage in stages}
+        self.store = store or ArtifactStore()
+        # Optional profile_utils.StageProfiler - stages then run one at a time so each profile
+        # and allocation report covers only its own stage
+        self.profiler = profiler
+        self.max_workers = 1 if profiler else max_workers
+        self.producers = {}
+        self.timings = {}
+        self.check_stages()
+
+    def check_stages(self):
+        for stage in self.stages.values():
+            for output in stage.outputs:
+                if output in self.producers:
+                    raise ValueError(f"Output '{output}' is produced by both '{self.producers[output]}' and '{stage.name}'.")
+                self.producers[output] = stage.name
+        for stage in self.stages.values():
+            missing = [name for name in stage.inputs if name not in self.producers and name not in self.store.artifacts]
+            if missing:
+                raise ValueError(f"Stage '{stage.name}' needs {missing}, which no stage produces.")
+
+    def dependencies(self, stage):
+        return set(self.producers[name] for name in stage.inputs if name in self.producers)
+
+    def run_stage(self, stage):
+        if self.profiler:
+            with self.profiler.profile(stage.name):
+                return self.execute_stage(stage)
+        return self.execute_stage(stage)
+
+    def execute_stage(self, stage):
+        start = time.perf_counter()
+        if stage.memoise:
+            self.store.run_stage(stage.name, stage.func, stage.inputs, stage.outputs, stage.version)
+        else:
+            outputs = stage.func(**{name: self.store.get(name) for name in stage.inputs})
+            if len(stage.outputs) == 1:
+                outputs = (outputs,)
+            for name, value in zip(stage.outputs, outputs or ()):
+                self.store.put(name, value, persist=False)
+        return start, time.perf_counter()
+
+    def run(self):
+        pending = dict(self.stages)
+        done = set()
+        running = {}
+        pipeline_start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                for name, stage in list(pending.items()):
+                    if self.dependencies(stage) <= done:
+                        logging.info(f"Starting stage {name}")
+                        running[executor.submit(self.run_stage, stage)] = name
+                        del pending[name]
+                if not running:
+                    raise ValueError(f"Stages {sorted(pending)} have circular dependencies.")
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    # Re-raise stage errors here rather than carrying on without its outputs
+                    start, end = future.result()
+                    self.timings[name] = (start - pipeline_start, end - pipeline_start)
+                    done.add(name)
+                    logging.info(f"Finished stage {name} in {end - start:.1f}s")
+        return self.store
+
+    def critical_path(self):
+        # Walk back from the last stage to finish through whichever dependency finished last
+        name = max(self.timings, key=lambda stage_name: self.timings[stage_name][1])
+        path = [name]
+        while True:
+            dependencies = self.dependencies(self.stages[name])
+            if not dependencies:
+                break
+            name = max(dependencies, key=lambda stage_name: self.timings[stage_name][1])
+            path.append(name)
+        return list(reversed(path))
+
+    def print_report(self):
+        print("Stage timings:")
+        for name, (start, end) in sorted(self.timings.items(), key=lambda item: item[1][0]):
+            print(f"  {name}: {end - start:.1f}s (started at {start:.1f}s)")
+        path = self.critical_path()
+        print(f"Critical path: {' -> '.join(path)} ({self.timings[path[-1]][1]:.1f}s)")
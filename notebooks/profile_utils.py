@@ -0,0 +1,84 @@
+import os
+import io
+import time
+import pstats
+import cProfile
+import tracemalloc
+from datetime import datetime
+from contextlib import contextmanager
+
+def profiling_enabled():
+    # Opt-in from the environment, e.g. BSA_PROFILE=1 python run_me.py
+    return os.environ.get("BSA_PROFILE", "").lower() in ("1", "true", "yes")
+
+class StageProfiler:
+    """
+    Profiles named stages with cProfile and tracemalloc, writing for each stage a .prof file
+    (for snakeviz or pstats), the top functions by cumulative time and the top allocation sites.
+    """
+    def __init__(self, output_dir=None, top_n=25, memory=True):
+        self.output_dir = output_dir or os.path.join("..", "data", "profiles", datetime.now().strftime("%Y%m%d-%H%M%S"))
+        self.top_n = top_n
+        self.memory = memory
+        self.summary = {}
+
+    @contextmanager
+    def profile(self, name):
+        os.makedirs(self.output_dir, exist_ok=True)
+        profiler = cProfile.Profile()
+        if self.memory:
+            started_tracing = not tracemalloc.is_tracing()
+            if started_tracing:
+                tracemalloc.start(10)
+            tracemalloc.reset_peak()
+            before = tracemalloc.take_snapshot()
+        start = time.perf_counter()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            elapsed = time.perf_counter() - start
+            self.summary[name] = {"seconds": elapsed}
+            if self.memory:
+                # Snapshot before writing anything, so the report covers only the stage itself
+                after = tracemalloc.take_snapshot()
+                self.summary[name]["peak_mb"] = tracemalloc.get_traced_memory()[1] / 1e6
+                if started_tracing:
+                    tracemalloc.stop()
+                self.write_allocations(name, self.stage_only(after).compare_to(self.stage_only(before), 'lineno'))
+            self.write_profile(name, profiler)
+
+    @staticmethod
+    def stage_only(snapshot):
+        return snapshot.filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, cProfile.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+        ])
+
+    def write_profile(self, name, profiler):
+        profiler.dump_stats(os.path.join(self.output_dir, f"{name}.prof"))
+        output = io.StringIO()
+        pstats.Stats(profiler, stream=output).sort_stats("cumulative").print_stats(self.top_n)
+        with open(os.path.join(self.output_dir, f"{name}_top.txt"), 'w') as f:
+            f.write(output.getvalue())
+
+    def write_allocations(self, name, differences):
+        with open(os.path.join(self.output_dir, f"{name}_memory.txt"), 'w') as f:
+            f.write(f"Top {self.top_n} allocation sites during {name} (net change since the stage started)\n")
+            for difference in differences[:self.top_n]:
+                f.write(f"{difference}\n")
+
+    def write_summary(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        lines = []
+        for name, stats in sorted(self.summary.items(), key=lambda item: -item[1]["seconds"]):
+            line = f"{name}: {stats['seconds']:.2f}s"
+            if "peak_mb" in stats:
+                line += f", peak traced memory {stats['peak_mb']:.0f} MB"
+            lines.append(line)
+        with open(os.path.join(self.output_dir, "summary.txt"), 'w') as f:
+            f.write("\n".join(lines) + "\n")
+        print(f"Profiles written to {self.output_dir}")
+        return lines
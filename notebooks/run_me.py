@@ -2,45 +2,322 @@ import pandas as pd
 import bsa_utils
 import utils
 import testing_utils
+import artifact_utils
+import pipeline_utils
+import similarity_utils
+import spill_utils
+import profile_utils
+import shutil
 import os
+import re
+import json
+import time
+import logging
+import argparse
+from concurrent.futures import ProcessPoolExecutor
 
-def main():
-    dataset_id = "english-prescribing-data-epd"  # Dataset ID
+DATASET_ID = "english-prescribing-data-epd"  # Dataset ID
 
-    # FIND NEW PRODUCTS
-    sql = (
-        "SELECT DISTINCT BNF_CODE, BNF_DESCRIPTION, CHEMICAL_SUBSTANCE_BNF_DESCR "
-        "{FROM_TABLE}"
-    )
+# FIND NEW PRODUCTS
+NEW_PRODUCTS_SQL = (
+    "SELECT DISTINCT BNF_CODE, BNF_DESCRIPTION, CHEMICAL_SUBSTANCE_BNF_DESCR "
+    "{FROM_TABLE}"
+)
+
+SPILL_DIR = os.path.join("..", "data", "spill")
+
+def main(out_of_core=False, profile=None):
+    """
+    Produces the new item and testing reports for the latest month. With out_of_core the history
+    is streamed to disk a few months at a time instead of being held in memory. With profile
+    (or BSA_PROFILE=1) each stage is profiled and the results written to ../data/profiles.
+    """
+    if profile is None:
+        profile = profile_utils.profiling_enabled()
+    profiler = profile_utils.StageProfiler() if profile else None
+
+    dataset_id = DATASET_ID
+    sql = NEW_PRODUCTS_SQL
+
+    # Both extracts share categories so the comparison can work on integer codes
+    categories = bsa_utils.CategoryRegistry()
+
+    def fetch_existing():
+        # Extract existing data from EPD
+        date_from = "earliest"  # Can be "YYYYMM" or "earliest" or "latest", default="earliest"
+        date_to = "latest-1"  # Can be "YYYYMM" or "latest" or "latest-1", default="latest"
+
+        # Fetch existing data using BSA API
+        existing_data_extract = bsa_utils.FetchData(resource=dataset_id, date_from=date_from, date_to=date_to, sql=sql, cache=True, categories=categories)
+        return existing_data_extract.results()
+
+    def fetch_latest():
+        # Extract latest data from EPD
+        date_from = "latest"  # Can be "YYYYMM" or "earliest" or "latest", default="earliest"
+        date_to = "latest"  # Can be "YYYYMM" or "latest" or "latest-1", default="latest"
+
+        # Fetch latest data using BSA API
+        latest_data_extract = bsa_utils.FetchData(resource=dataset_id, date_from=date_from, date_to=date_to, sql=sql, categories=categories)
+        return latest_data_extract.results(), latest_data_extract.return_resources_to()
+
+    def fetch_existing_out_of_core():
+        return spill_history(dataset_id, sql, "earliest", "latest-1", SPILL_DIR)
+
+    def find_similar(existing, bnf_codes, new_desc_only):
+        return similarity_utils.find_similar_descriptions(existing, [bnf_codes, new_desc_only])
+
+    def find_similar_out_of_core(description_index, bnf_codes, new_desc_only):
+        return similarity_utils.find_similar_descriptions(None, [bnf_codes, new_desc_only], index=description_index)
+
+    def new_item_report(chem_subs, bnf_codes, new_desc_only, similar, data_for):
+        utils.write_monthly_report_html(chem_subs, bnf_codes, new_desc_only, data_for, similar=similar)
+        utils.generate_list_reports_html()
+
+    def measure_tests(bnf_codes, data_for, measures, definition_changes):
+        testing_utils.run_tests(bnf_codes, data_for, measures=measures, definition_changes=definition_changes)
 
-    # Extract existing data from EPD
-    date_from = "earliest"  # Can be "YYYYMM" or "earliest" or "latest", default="earliest"
-    date_to = "latest-1"  # Can be "YYYYMM" or "latest" or "latest-1", default="latest"
+    # The two fetches and measure loading are independent and run concurrently. Stage outputs are
+    # handed on in memory, and the comparison is persisted so it is not repeated for unchanged inputs
+    if out_of_core:
+        existing_stages = [
+            pipeline_utils.Stage("fetch_existing", fetch_existing_out_of_core, outputs=["existing", "description_index"]),
+            pipeline_utils.Stage(
+                "find_similar", find_similar_out_of_core, inputs=["description_index", "bnf_codes", "new_desc_only"],
+                outputs=["similar"]
+            ),
+        ]
+    else:
+        existing_stages = [
+            pipeline_utils.Stage("fetch_existing", fetch_existing, outputs=["existing"]),
+            pipeline_utils.Stage(
+                "find_similar", find_similar, inputs=["existing", "bnf_codes", "new_desc_only"], outputs=["similar"], memoise=True,
+                version=artifact_utils.code_fingerprint(
+                    find_similar, similarity_utils.find_similar_descriptions, similarity_utils.DescriptionIndex
+                )
+            ),
+        ]
 
-    # Fetch existing data using BSA API
-    existing_data_extract = bsa_utils.FetchData(resource=dataset_id, date_from=date_from, date_to=date_to, sql=sql, cache=True)
+    pipeline = pipeline_utils.Pipeline(existing_stages + [
+        pipeline_utils.Stage("fetch_latest", fetch_latest, outputs=["latest", "data_for"]),
+        pipeline_utils.Stage("load_measures", testing_utils.load_measures, outputs=["measures"]),
+        pipeline_utils.Stage(
+            "compare", compare_latest, inputs=["existing", "latest"],
+            outputs=["chem_subs", "bnf_codes", "new_desc_only"], memoise=True,
+            version=artifact_utils.code_fingerprint(compare_latest, utils.CompareLatest)
+        ),
+        pipeline_utils.Stage(
+            "new_item_report", new_item_report, inputs=["chem_subs", "bnf_codes", "new_desc_only", "similar", "data_for"]
+        ),
+        pipeline_utils.Stage("update_universe", update_code_universe, inputs=["existing", "latest"], outputs=["universe"]),
+        pipeline_utils.Stage(
+            "revalidate_measures", testing_utils.revalidate_measures, inputs=["universe", "measures"],
+            outputs=["definition_changes"]
+        ),
+        pipeline_utils.Stage(
+            "measure_tests", measure_tests, inputs=["bnf_codes", "data_for", "measures", "definition_changes"]
+        ),
+    ], store=artifact_utils.ArtifactStore(persist=True), profiler=profiler)
+    pipeline.run()
+    pipeline.print_report()
+    if profiler:
+        profiler.write_summary()
 
-    # Extract latest data from EPD
-    date_from = "latest"  # Can be "YYYYMM" or "earliest" or "latest", default="earliest"
-    date_to = "latest"  # Can be "YYYYMM" or "latest" or "latest-1", default="latest"
+def compare_latest(existing, latest, exclude_chapters=[]):
+    if isinstance(existing, spill_utils.KeySpill):
+        compare_data = utils.CompareLatest(None, latest, exclude_chapters=exclude_chapters, existing_keys=existing)
+    else:
+        compare_data = utils.CompareLatest(existing, latest, exclude_chapters=exclude_chapters)
+    return compare_data.return_new_chem_subs(), compare_data.return_new_bnf_codes(), compare_data.return_new_desc_only()
 
-    # Fetch latest data using BSA API
-    latest_data_extract = bsa_utils.FetchData(resource=dataset_id, date_from=date_from, date_to=date_to, sql=sql)
+def update_code_universe(existing, latest):
+    # The history only needs adding once; after that each month adds its own codes. A spill has
+    # already added its months as they were streamed
+    if isinstance(existing, spill_utils.KeySpill) or os.path.exists(testing_utils.CODE_UNIVERSE_FILE):
+        return testing_utils.update_code_universe(latest)
+    return testing_utils.update_code_universe(existing, latest)
 
-    compare_data = utils.CompareLatest(
-        existing_data_extract.results(),
-        latest_data_extract.results(),
-        exclude_chapters=[]
+def revalidate_measures(save=False):
+    """
+    Re-checks only the measures whose definition has changed against every BNF code seen so far,
+    without fetching anything, and prints the codes each edit adds or removes. This is a dry run
+    unless save is set, so the changes still appear in the next monthly testing report.
+    """
+    if not os.path.exists(testing_utils.CODE_UNIVERSE_FILE):
+        print("No BNF code universe yet, run the monthly reports first.")
+        return
+    changes = testing_utils.revalidate_measures(testing_utils.load_code_universe(), save=save)
+    if not changes:
+        print("No measure definitions have changed.")
+    for change in changes:
+        if "added" not in change:
+            print(f"{change['title']}: new measure, matches {change['matches']} codes")
+            continue
+        print(f"{change['title']}: {len(change['added'])} codes now matched, {len(change['removed'])} codes no longer matched")
+        table = testing_utils.definition_change_table([change])
+        if not table.empty:
+            print(table[['CHANGE', 'BNF_CODE', 'BNF_DESCRIPTION']].to_string(index=False))
+
+def spill_history(dataset_id, sql, date_from, date_to, spill_dir, exclude_chapters=[], chunk_months=6):
+    """
+    Streams the history to a KeySpill and a DescriptionIndex a few months at a time, so only
+    chunk_months months of full rows are in memory at once.
+    """
+    shutil.rmtree(spill_dir, ignore_errors=True)
+    spill = spill_utils.KeySpill(spill_dir)
+    index = similarity_utils.DescriptionIndex()
+    months = [date.strftime('%Y%m') for date in bsa_utils.ResourceNames(dataset_id, date_from, date_to).return_date_list()]
+    for i in range(0, len(months), chunk_months):
+        extract = bsa_utils.FetchData(resource=dataset_id, sql=sql, date_from=None, date_to=None, cache=True, months=months[i:i + chunk_months])
+        for month, month_df in extract.results_by_month().items():
+            if exclude_chapters:
+                month_df = utils.CompareLatest.exclude_these_chapters(month_df, exclude_chapters)
+            spill.add(month_df, label=month)
+            index.add(month_df)
+            testing_utils.update_code_universe(month_df)
+        del extract
+    # Merge each partition's runs so lookups read one sorted file per partition
+    spill.compact()
+    return spill, index
+
+def backfill_months(history_df, months, exclude_chapters, measures):
+    # Runs in a worker process: compares each month with everything before it, oldest first
+    seen_df = history_df
+    # The description index is extended month by month rather than rebuilt
+    index = similarity_utils.DescriptionIndex(history_df)
+    for data_for, month_df in months:
+        chem_subs, bnf_codes, new_desc_only = compare_latest(seen_df, month_df, exclude_chapters)
+        similar = similarity_utils.find_similar_descriptions(seen_df, [bnf_codes, new_desc_only], index=index)
+        utils.write_monthly_report_html(chem_subs, bnf_codes, new_desc_only, data_for, similar=similar)
+        testing_utils.run_tests(bnf_codes, data_for, measures=measures, update_index=False)
+        seen_df = pd.concat([seen_df, month_df], ignore_index=True).drop_duplicates(ignore_index=True)
+        index.add(month_df)
+    return [data_for for data_for, _ in months]
+
+def backfill(date_from="earliest+1", date_to="latest", workers=None, exclude_chapters=[]):
+    """
+    Regenerates the monthly new item and testing reports for every month in a range
+    from a single pull of the full history.
+    """
+    workers = workers or os.cpu_count()
+
+    # One pass over every month up to date_to, each month is compared with all months before it
+    extract = bsa_utils.FetchData(
+        resource=DATASET_ID, date_from="earliest", date_to=date_to, sql=NEW_PRODUCTS_SQL, cache=True,
+        categories=bsa_utils.CategoryRegistry()
     )
+    monthly_results = extract.results_by_month()
+    first_month = pd.Timestamp(extract.resource_names_obj.set_date(date_from, date_type="from")).strftime('%Y-%m')
+    report_months = [month for month in monthly_results if month >= first_month]
+    if not report_months:
+        print("No months to backfill.")
+        return
+
+    measures = testing_utils.load_measures()
+    testing_utils.update_code_universe(extract.results())
+
+    # Split the months into contiguous chunks, one per worker, each starting from the history before it
+    chunk_size = -(-len(report_months) // workers)
+    chunks = [report_months[i:i + chunk_size] for i in range(0, len(report_months), chunk_size)]
+    chunk_starts = set(chunk[0] for chunk in chunks)
+    history = {}
+    seen_df = extract.results().iloc[0:0]
+    for month, month_df in monthly_results.items():
+        if month in chunk_starts:
+            history[month] = seen_df
+            if len(history) == len(chunks):
+                break
+        seen_df = pd.concat([seen_df, month_df], ignore_index=True).drop_duplicates(ignore_index=True)
+    jobs = [(history[chunk[0]], [(month, monthly_results[month]) for month in chunk]) for chunk in chunks]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(backfill_months, history_df, months, exclude_chapters, measures) for history_df, months in jobs]
+        for future in futures:
+            print(f"Backfilled {', '.join(future.result())}")
 
-    chem_subs = compare_data.return_new_chem_subs()
-    bnf_codes = compare_data.return_new_bnf_codes()
-    return_new_desc_only = compare_data.return_new_desc_only()
-    data_for = latest_data_extract.return_resources_to()
-    utils.write_monthly_report_html(chem_subs, bnf_codes, return_new_desc_only, data_for)
     utils.generate_list_reports_html()
+    testing_utils.generate_list_reports_html()
 
-    testing_utils.run_tests(bnf_codes, data_for)
+POLL_STATE_FILE = os.path.join("..", "data", "poll_state.json")
+
+def last_processed_month(reports_dir=os.path.join("..", "reports")):
+    # Latest 'YYYY-MM' with a monthly new item report
+    months = [
+        match.group(1)
+        for match in (re.match(r'monthly_report_(\d{4}-\d{2})\.html$', f) for f in os.listdir(reports_dir))
+        if match
+    ] if os.path.exists(reports_dir) else []
+    return max(months) if months else None
+
+def check_for_new_month():
+    """
+    Returns the latest month published if it is newer than the last report, otherwise None.
+    Uses a conditional request so an unchanged package costs a 304 with no body.
+    """
+    state = {}
+    if os.path.exists(POLL_STATE_FILE):
+        with open(POLL_STATE_FILE, 'r') as f:
+            state = json.load(f)
+
+    metadata, validators = bsa_utils.fetch_package_metadata(DATASET_ID, state.get("etag"), state.get("last_modified"))
+    if metadata is None:
+        latest_month = state.get("latest_month")
+    else:
+        latest_month = bsa_utils.latest_resource_month(metadata)
+    state.update(validators, latest_month=latest_month)
+    os.makedirs(os.path.dirname(POLL_STATE_FILE), exist_ok=True)
+    with open(POLL_STATE_FILE, 'w') as f:
+        json.dump(state, f, indent=4)
+
+    processed = last_processed_month()
+    if latest_month and (processed is None or latest_month > processed):
+        return latest_month
+    return None
+
+def watch(interval=3600, once=False):
+    """
+    Polls for a newly published month and runs the monthly pipeline when one appears.
+    """
+    while True:
+        try:
+            new_month = check_for_new_month()
+        except Exception as e:
+            # A failed poll should not stop the watcher, try again next time
+            print(f"Polling failed: {e}")
+            new_month = None
+        if new_month:
+            print(f"New data published for {new_month}, running monthly reports.")
+            try:
+                main()
+            except Exception:
+                # The month has no report yet, so the next poll finds it again and retries
+                logging.exception(f"Monthly reports for {new_month} failed, will retry at the next poll")
+        else:
+            print("No new data published.")
+        if once:
+            return new_month
+        time.sleep(interval)
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Produce the monthly new item and testing reports.")
+    parser.add_argument("--backfill", action="store_true", help="Regenerate the reports for a range of months")
+    parser.add_argument("--date-from", default="earliest+1", help="First month to backfill (default: earliest+1)")
+    parser.add_argument("--date-to", default="latest", help="Last month to backfill (default: latest)")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes for backfill (default: CPU count)")
+    parser.add_argument("--watch", action="store_true", help="Poll for newly published data and run when it appears")
+    parser.add_argument("--interval", type=int, default=3600, help="Seconds between polls when watching (default: 3600)")
+    parser.add_argument("--once", action="store_true", help="Poll once rather than continuously when watching")
+    parser.add_argument("--profile", action="store_true", default=None, help="Profile each stage (also enabled by BSA_PROFILE=1)")
+    parser.add_argument("--revalidate-measures", action="store_true", help="Check edited measure definitions against every code seen")
+    parser.add_argument("--save-definitions", action="store_true",
+                        help="With --revalidate-measures, record the definitions as seen so the monthly report does not repeat them")
+    parser.add_argument("--out-of-core", action="store_true", help="Stream the history to disk rather than holding it in memory")
+    args = parser.parse_args()
+
+    if args.backfill:
+        backfill(args.date_from, args.date_to, args.workers)
+    elif args.revalidate_measures:
+        revalidate_measures(save=args.save_definitions)
+    elif args.watch:
+        watch(args.interval, args.once)
+    else:
+        main(out_of_core=args.out_of_core, profile=args.profile)
@@ -0,0 +1,107 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+class DescriptionIndex:
+    """
+    Character n-gram TF-IDF index over BNF descriptions, used to find the nearest existing
+    descriptions to new or re-described products. Rows can be added month by month.
+    """
+    def __init__(self, df=None, n=3):
+        self.n = n
+        self.vocabulary = {}
+        self.descriptions = []
+        self.codes = []
+        self.description_set = set()
+        self.blocks = []
+        self.matrix = None
+        self.weighted = None
+        if df is not None:
+            self.add(df)
+
+    def ngrams(self, text):
+        text = f" {text.lower()} "
+        return set(text[i:i + self.n] for i in range(len(text) - self.n + 1))
+
+    def vectorise(self, descriptions, grow=False):
+        # Binary n-gram presence matrix; unknown n-grams are added to the vocabulary only when growing
+        indices = []
+        indptr = [0]
+        for description in descriptions:
+            for gram in self.ngrams(description):
+                column = self.vocabulary.get(gram)
+                if column is None and grow:
+                    column = self.vocabulary[gram] = len(self.vocabulary)
+                if column is not None:
+                    indices.append(column)
+            indptr.append(len(indices))
+        data = np.ones(len(indices), dtype=np.float32)
+        return sparse.csr_matrix((data, indices, indptr), shape=(len(descriptions), len(self.vocabulary)))
+
+    def add(self, df):
+        new_rows = df[['BNF_CODE', 'BNF_DESCRIPTION']].dropna().drop_duplicates('BNF_DESCRIPTION')
+        new_rows = new_rows[~new_rows['BNF_DESCRIPTION'].isin(self.description_set)]
+        if new_rows.empty:
+            return
+        descriptions = new_rows['BNF_DESCRIPTION'].astype(str).tolist()
+        self.blocks.append(self.vectorise(descriptions, grow=True))
+        self.descriptions.extend(descriptions)
+        self.codes.extend(new_rows['BNF_CODE'].astype(str).tolist())
+        self.description_set.update(descriptions)
+        self.matrix = None
+
+    def build(self):
+        # Weighted matrix and norms are rebuilt only after rows have been added
+        if self.matrix is None:
+            # Earlier blocks were built with a smaller vocabulary
+            for block in self.blocks:
+                block.resize((block.shape[0], len(self.vocabulary)))
+            self.matrix = sparse.vstack(self.blocks, format='csr')
+            self.blocks = [self.matrix]
+            document_frequency = np.bincount(self.matrix.indices, minlength=len(self.vocabulary))
+            self.idf = np.log((1 + len(self.descriptions)) / (1 + document_frequency)) + 1
+            self.weighted = self.matrix.multiply(self.idf).tocsr()
+            self.norms = np.sqrt(np.asarray(self.weighted.multiply(self.weighted).sum(axis=1)).ravel())
+
+    def query(self, df, k=3, min_similarity=0.5):
+        """
+        Returns the top-k most similar existing descriptions for each row of df, as one row per match.
+        """
+        columns = ['BNF_CODE', 'BNF_DESCRIPTION', 'RANK', 'SIMILAR_BNF_CODE', 'SIMILAR_BNF_DESCRIPTION', 'SIMILARITY']
+        if df.empty or not self.descriptions:
+            return pd.DataFrame(columns=columns)
+        self.build()
+
+        # Cosine similarity of IDF-weighted n-gram vectors, for the whole batch in one product
+        query_weighted = self.vectorise(df['BNF_DESCRIPTION'].astype(str).tolist()).multiply(self.idf).tocsr()
+        query_norms = np.sqrt(np.asarray(query_weighted.multiply(query_weighted).sum(axis=1)).ravel())
+        scores = (query_weighted @ self.weighted.T).tocsr()
+
+        rows = []
+        codes = df['BNF_CODE'].astype(str).tolist()
+        descriptions = df['BNF_DESCRIPTION'].astype(str).tolist()
+        for i in range(scores.shape[0]):
+            start, end = scores.indptr[i], scores.indptr[i + 1]
+            if start == end or query_norms[i] == 0:
+                continue
+            candidates = scores.indices[start:end]
+            similarity = scores.data[start:end] / (query_norms[i] * self.norms[candidates])
+            top = np.argpartition(-similarity, k)[:k] if len(similarity) > k else np.arange(len(similarity))
+            top = top[np.argsort(-similarity[top])]
+            for rank, j in enumerate(top, start=1):
+                if similarity[j] < min_similarity:
+                    break
+                match = candidates[j]
+                rows.append([codes[i], descriptions[i], rank, self.codes[match], self.descriptions[match], round(float(similarity[j]), 3)])
+        return pd.DataFrame(rows, columns=columns)
+
+def find_similar_descriptions(df_existing, new_item_frames, k=3, min_similarity=0.5, index=None):
+    """
+    Nearest existing descriptions for the new codes and descriptions found by CompareLatest.
+    An index already built over df_existing can be passed in to save rebuilding it.
+    """
+    if index is None:
+        index = DescriptionIndex(df_existing)
+    new_items = pd.concat(new_item_frames, ignore_index=True)
+    new_items = new_items[['BNF_CODE', 'BNF_DESCRIPTION']].astype(str).drop_duplicates()
+    return index.query(new_items, k=k, min_similarity=min_similarity)
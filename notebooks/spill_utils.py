@@ -0,0 +1,120 @@
+import os
+import glob
+import heapq
+import hashlib
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+KEY_COLUMNS = ['BNF_CODE', 'BNF_DESCRIPTION', 'CHEMICAL_SUBSTANCE_BNF_DESCR']
+
+class KeySpill:
+    """
+    Disk-backed set of the distinct values of each key column seen in the history. Months are
+    added one at a time as sorted runs in hash partitions, and merged into one sorted file per
+    partition, so memory is bounded by a month and a partition rather than the whole history.
+    """
+    def __init__(self, spill_dir=None, columns=KEY_COLUMNS, partitions=16, batch_size=65536):
+        self.spill_dir = spill_dir or tempfile.mkdtemp(prefix="key_spill_")
+        self.columns = list(columns)
+        self.partitions = partitions
+        self.batch_size = batch_size
+        self.run_count = 0
+        self.added = []
+
+    def __str__(self):
+        return f"KeySpill({', '.join(self.added)})"
+
+    def content_digest(self):
+        """
+        Hash of the values on disk, so memoised stages taking a spill are re-run when a month is
+        republished or filtered differently, not just when the months change.
+        """
+        digest = hashlib.sha256()
+        for run in sorted(glob.glob(os.path.join(self.spill_dir, "*", "part_*", "run_*.parquet"))):
+            digest.update(os.path.relpath(run, self.spill_dir).split(os.sep, 2)[0].encode())
+            digest.update(os.path.basename(os.path.dirname(run)).encode())
+            for batch in pq.ParquetFile(run).iter_batches(batch_size=self.batch_size):
+                digest.update("\n".join(batch.column(0).to_pylist()).encode())
+                digest.update(b"\0")
+        return digest.hexdigest()
+
+    def partition_dir(self, column, partition):
+        return os.path.join(self.spill_dir, column, f"part_{partition:03d}")
+
+    def partition_of(self, values):
+        return pd.util.hash_array(values) % self.partitions
+
+    @staticmethod
+    def distinct_values(series):
+        return np.asarray(pd.unique(series.dropna().astype(str)), dtype=object)
+
+    def add(self, df, label=None):
+        """
+        Adds the distinct key values of a month (or any chunk of the history) as sorted runs.
+        """
+        self.run_count += 1
+        self.added.append(str(label if label is not None else self.run_count))
+        for column in self.columns:
+            values = self.distinct_values(df[column])
+            partitions = self.partition_of(values)
+            for partition in np.unique(partitions):
+                run = np.sort(values[partitions == partition])
+                os.makedirs(self.partition_dir(column, partition), exist_ok=True)
+                run_file = os.path.join(self.partition_dir(column, partition), f"run_{self.run_count:06d}.parquet")
+                pq.write_table(pa.table({"value": pa.array(run, pa.string())}), run_file)
+
+    def iter_sorted(self, run_file):
+        for batch in pq.ParquetFile(run_file).iter_batches(batch_size=self.batch_size):
+            yield from batch.column(0).to_pylist()
+
+    def compact(self):
+        """
+        External merge of each partition's runs into a single sorted, de-duplicated file.
+        """
+        for column in self.columns:
+            for partition_dir in glob.glob(os.path.join(self.spill_dir, column, "part_*")):
+                runs = sorted(glob.glob(os.path.join(partition_dir, "run_*.parquet")))
+                if len(runs) < 2:
+                    continue
+                merged_file = os.path.join(partition_dir, f"run_{self.run_count:06d}.merged")
+                writer = pq.ParquetWriter(merged_file, pa.schema([("value", pa.string())]))
+                batch = []
+                previous = None
+                for value in heapq.merge(*(self.iter_sorted(run) for run in runs)):
+                    if value != previous:
+                        batch.append(value)
+                        previous = value
+                    if len(batch) >= self.batch_size:
+                        writer.write_table(pa.table({"value": pa.array(batch, pa.string())}))
+                        batch = []
+                if batch:
+                    writer.write_table(pa.table({"value": pa.array(batch, pa.string())}))
+                writer.close()
+                for run in runs:
+                    os.remove(run)
+                os.replace(merged_file, os.path.join(partition_dir, f"run_{self.run_count:06d}.parquet"))
+
+    def contains(self, column, series):
+        """
+        Boolean mask of the rows of series whose value has been seen, reading one partition's
+        runs a batch at a time.
+        """
+        values = self.distinct_values(series)
+        seen = set()
+        partitions = self.partition_of(values)
+        for partition in np.unique(partitions):
+            wanted = np.sort(values[partitions == partition])
+            found = np.zeros(len(wanted), dtype=bool)
+            for run in glob.glob(os.path.join(self.partition_dir(column, partition), "run_*.parquet")):
+                for batch in pq.ParquetFile(run).iter_batches(batch_size=self.batch_size):
+                    found |= np.isin(wanted, np.asarray(batch.column(0).to_pylist(), dtype=object))
+            seen.update(wanted[found])
+        # Missing values are never reported as new, as with categorical codes
+        return series.astype(str).isin(seen) | series.isna()
+
+    def remove(self):
+        shutil.rmtree(self.spill_dir, ignore_errors=True)
@@ -0,0 +1,108 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+# Units as they appear in BNF descriptions, longest spelling first, with the unit they normalise to
+UNITS = {
+    'micrograms': 'microgram', 'microgram': 'microgram', 'microg': 'microgram', 'mcg': 'microgram',
+    'milligrams': 'mg', 'milligram': 'mg', 'mg': 'mg',
+    'nanograms': 'nanogram', 'nanogram': 'nanogram', 'ng': 'nanogram',
+    'grams': 'g', 'gram': 'g', 'g': 'g',
+    'mmol': 'mmol', 'ml': 'ml', 'units': 'unit', 'unit': 'unit', '%': '%',
+}
+UNIT_PATTERN = '|'.join(sorted(map(str, UNITS), key=len, reverse=True))
+NUMBER_PATTERN = r'\d+(?:\.\d+)?'
+
+# "100/50mcg" -> "100mcg/50mcg", so every component of a combination carries its unit
+SHARED_UNIT_PATTERN = rf'({NUMBER_PATTERN})/(?=(?:{NUMBER_PATTERN}/)*{NUMBER_PATTERN}\s?({UNIT_PATTERN})(?![a-z]))'
+# "250micrograms/dose", "12.75microg", "250mg/5ml"
+STRENGTH_PATTERN = rf'(?P<value>{NUMBER_PATTERN})\s?(?P<unit>{UNIT_PATTERN})(?![a-z])(?:\s?/\s?(?P<per>(?:{NUMBER_PATTERN})?\s?(?:dose|ml|g)\b))?'
+# Brand names with a bare strength such as "Qvar 50 inhaler" or "Symbicort 100/6 Turbohaler"
+BARE_STRENGTH_PATTERN = rf'(?<![\d.])({NUMBER_PATTERN}(?:/{NUMBER_PATTERN})*)(?![\d./])(?!\s?D\b)'
+# "(200 D)", "(120D)", "60D"
+DOSES_PATTERN = r'(\d+)\s?D\b'
+
+def parse_unique_descriptions(descriptions):
+    # Parses a Series of distinct descriptions; every step is a single vectorised string operation
+    expanded = descriptions.str.replace(SHARED_UNIT_PATTERN, r'\1\2/', regex=True, case=False)
+    matches = expanded.str.extractall(STRENGTH_PATTERN, flags=2)  # re.IGNORECASE
+    matches['value'] = matches['value'].astype(float)
+    matches['unit'] = matches['unit'].str.lower().map(UNITS)
+    grouped = matches.groupby(level=0)
+
+    parsed = pd.DataFrame(index=descriptions.index)
+    # The first strength of each description; selected by mask as xs fails when nothing matched
+    first = matches[matches.index.get_level_values('match') == 0].droplevel('match')
+    parsed['STRENGTH'] = first['value']
+    parsed['STRENGTH_UNIT'] = first['unit']
+    parsed['STRENGTH_PER'] = first['per'].str.replace(' ', '').str.lower()
+    parsed['STRENGTHS'] = grouped['value'].agg(tuple)
+
+    # Fall back to a bare number only where no strength with a unit was found
+    missing = parsed['STRENGTH'].isna()
+    bare = descriptions[missing].str.extract(BARE_STRENGTH_PATTERN, expand=False).dropna()
+    bare_values = bare.str.split('/').map(lambda values: tuple(float(value) for value in values))
+    parsed.loc[bare_values.index, 'STRENGTHS'] = bare_values
+    parsed.loc[bare_values.index, 'STRENGTH'] = bare_values.str[0]
+
+    parsed['DOSES'] = descriptions.str.extract(DOSES_PATTERN, expand=False).astype(float)
+    return parsed
+
+def parse_strengths(descriptions):
+    """
+    Extracts strength, unit and dose count from a column of BNF descriptions.
+    Each distinct description is parsed once and the results mapped back to every row.
+    """
+    if isinstance(descriptions.dtype, pd.CategoricalDtype):
+        # Shared registries hold every description ever seen, only parse the ones present
+        descriptions = descriptions.cat.remove_unused_categories()
+        codes = descriptions.cat.codes.to_numpy()
+        uniques = pd.Series(descriptions.cat.categories.astype(str))
+    else:
+        codes, uniques = pd.factorize(descriptions)
+        uniques = pd.Series(uniques).astype(str)
+    parsed = parse_unique_descriptions(uniques.reset_index(drop=True))
+
+    # Rows with a missing description (code -1) take the all-empty row appended at the end
+    parsed = parsed.reindex(range(len(parsed) + 1))
+    result = parsed.iloc[np.where(codes >= 0, codes, len(parsed) - 1)]
+    result.index = descriptions.index
+    return result.astype({'STRENGTH': float, 'DOSES': float})
+
+def has_strength(parsed, strength):
+    # True where any component of the description has the given strength, e.g. either half of a combination
+    return parsed['STRENGTHS'].map(lambda values: isinstance(values, tuple) and strength in values)
+
+def validate_strengths(fixture_path=os.path.join("test_data", "steroid_inhalers-202404.csv")):
+    """
+    Compares strengths parsed from bnf_name with the dm+d strnt_nmrtr_val in the fixture.
+    Returns the fixture with the parsed columns and whether the expected strength was found.
+    """
+    fixture = pd.read_csv(fixture_path)
+    parsed = parse_strengths(fixture['bnf_name'])
+    fixture = pd.concat([fixture, parsed], axis=1)
+    fixture['FIRST_MATCHES'] = fixture['STRENGTH'] == fixture['strnt_nmrtr_val']
+    fixture['ANY_MATCHES'] = [
+        isinstance(values, tuple) and expected in values
+        for values, expected in zip(fixture['STRENGTHS'], fixture['strnt_nmrtr_val'])
+    ]
+    return fixture
+
+def main():
+    fixture = validate_strengths()
+    total = len(fixture)
+    print(f"Strength parsed for {fixture['STRENGTH'].notna().sum()} of {total} descriptions")
+    print(f"First strength matches dm+d for {fixture['FIRST_MATCHES'].sum()} of {total}")
+    print(f"Any component matches dm+d for {fixture['ANY_MATCHES'].sum()} of {total}")
+    print(f"Dose count parsed for {fixture['DOSES'].notna().sum()} of {total}")
+    mismatches = fixture[~fixture['ANY_MATCHES']]
+    if not mismatches.empty:
+        print("Descriptions where the dm+d strength was not found:")
+        print(mismatches[['bnf_name', 'strnt_nmrtr_val', 'STRENGTHS']].to_string(index=False))
+    # Most names state the strength, so a low match rate means the patterns have regressed
+    if fixture['ANY_MATCHES'].mean() < 0.9:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,12 @@
 import pandas as pd
+import numpy as np
 import os
 import json
+import hashlib
 import requests
+import strength_utils
+import bsa_utils
+import output_utils
 from bs4 import BeautifulSoup
 
 
@@ -181,19 +186,28 @@ def read_json_files_in_github():
 def wildcard_to_regex(pattern):
     return pattern.replace('%', '.*')
 
+# Match BNF codes against a regex pattern
+def bnf_code_contains(series, regex_pattern):
+    # For categoricals with fewer categories than rows, test each distinct code once and map back by integer code
+    if isinstance(series.dtype, pd.CategoricalDtype) and len(series.cat.categories) < len(series):
+        category_mask = np.asarray(series.cat.categories.str.contains(regex_pattern), dtype=bool)
+        codes = series.cat.codes.to_numpy()
+        return pd.Series((codes >= 0) & category_mask[codes], index=series.index)
+    return series.str.contains(regex_pattern)
+
 # Filter the DataFrame based on include and exclude lists
 def filter_include_exclude_dataframe(df, testing_include, testing_exclude):
     # Create a boolean mask for include patterns
     include_mask = pd.Series(False, index=df.index)
     for pattern in testing_include:
         regex_pattern = wildcard_to_regex(pattern)
-        include_mask |= df['BNF_CODE'].str.contains(regex_pattern)
+        include_mask |= bnf_code_contains(df['BNF_CODE'], regex_pattern)
 
     # Create a boolean mask for exclude patterns
     exclude_mask = pd.Series(False, index=df.index)
     for pattern in testing_exclude:
         regex_pattern = wildcard_to_regex(pattern)
-        exclude_mask |= df['BNF_CODE'].str.contains(regex_pattern)
+        exclude_mask |= bnf_code_contains(df['BNF_CODE'], regex_pattern)
 
     # Filter DataFrame: include and not exclude
     filtered_df = df[include_mask & ~exclude_mask]
@@ -216,13 +230,13 @@ def filter_num_bnf_codes_dataframe(df, testing_data):
     include_mask = pd.Series(False, index=df.index)
     for pattern in include_list:
         regex_pattern = wildcard_to_regex(pattern)
-        include_mask |= df['BNF_CODE'].str.contains(regex_pattern)
+        include_mask |= bnf_code_contains(df['BNF_CODE'], regex_pattern)
 
     # Create a boolean mask for exclude patterns
     exclude_mask = pd.Series(False, index=df.index)
     for pattern in exclude_list:
         regex_pattern = wildcard_to_regex(pattern)
-        exclude_mask |= df['BNF_CODE'].str.contains(regex_pattern)
+        exclude_mask |= bnf_code_contains(df['BNF_CODE'], regex_pattern)
 
     # Filter DataFrame: include and not exclude
     filtered_df = df[include_mask & ~exclude_mask]
@@ -248,9 +262,171 @@ def measures_filter(df, measure_data):
         result["test_triggered"] = False
     return result
     
+####### IMPACT OF TRIGGERED TESTS #######
+
+IMPACT_SQL = (
+    "SELECT BNF_CODE, SUM(ITEMS) AS ITEMS, SUM(TOTAL_QUANTITY) AS TOTAL_QUANTITY, SUM(ACTUAL_COST) AS ACTUAL_COST "
+    "{FROM_TABLE} WHERE BNF_CODE IN ({BNF_CODES}) GROUP BY BNF_CODE"
+)
+IMPACT_COLUMNS = ["ITEMS", "TOTAL_QUANTITY", "ACTUAL_COST"]
+# Keeps each request URL under the 8 KB many proxies allow (about 27 encoded characters a code)
+# if a month has an unusually large number of new codes
+IMPACT_BATCH_SIZE = 150
+
+def fetch_impact(bnf_codes, date_for, dataset_id="english-prescribing-data-epd"):
+    # Items, quantity and cost for all the codes in one query for the month rather than one per code
+    bnf_codes = sorted(set(map(str, bnf_codes)))
+    impact = [pd.DataFrame(columns=["BNF_CODE"] + IMPACT_COLUMNS)]
+    month = date_for.replace('-', '')
+    for i in range(0, len(bnf_codes), IMPACT_BATCH_SIZE):
+        in_list = ", ".join("'" + code.replace("'", "''") + "'" for code in bnf_codes[i:i + IMPACT_BATCH_SIZE])
+        sql = IMPACT_SQL.replace("{BNF_CODES}", in_list)
+        extract = bsa_utils.FetchData(resource=dataset_id, sql=sql, date_from=month, date_to=month, cache=True)
+        if extract.return_incomplete_months():
+            # Missing figures would otherwise read as codes that were not prescribed
+            raise RuntimeError(f"impact figures incomplete for {', '.join(extract.return_incomplete_months())}")
+        impact.append(extract.results())
+    # The empty placeholder only keeps the columns when nothing was fetched; concatenating it with
+    # results raises a FutureWarning about empty entries
+    impact = pd.concat(impact[1:] or impact, ignore_index=True)
+    impact["BNF_CODE"] = impact["BNF_CODE"].astype(str)
+    impact[IMPACT_COLUMNS] = impact[IMPACT_COLUMNS].apply(pd.to_numeric, errors='coerce')
+    # A month published as several tables returns a row per table for each code
+    return impact.groupby("BNF_CODE", as_index=False)[IMPACT_COLUMNS].sum()
+
+def add_impact(triggered_tests, date_for):
+    codes = set()
+    for item in triggered_tests:
+        codes.update(item['data']['BNF_CODE'].astype(str))
+    if not codes:
+        return
+    try:
+        impact = fetch_impact(codes, date_for)
+    except Exception as e:
+        # The report is still useful without impact figures
+        print(f"Impact query failed for {date_for}: {e}")
+        return
+    for item in triggered_tests:
+        data = item['data'].assign(BNF_CODE=item['data']['BNF_CODE'].astype(str))
+        item['impact'] = data[["BNF_CODE"]].merge(impact, on="BNF_CODE", how="left")
+        item['impact'][IMPACT_COLUMNS] = item['impact'][IMPACT_COLUMNS].fillna(0)
+
+def measure_result_tables(triggered_tests, passed_tests):
+    # One row per measure tested, and one row per new code matched by a triggered measure
+    results = []
+    matches = []
+    for item in triggered_tests + passed_tests:
+        result = {"MEASURE": item['title'], "TRIGGERED": item['test_triggered'], "MATCHES": len(item['data'])}
+        data = item['data'][["BNF_CODE", "BNF_DESCRIPTION", "CHEMICAL_SUBSTANCE_BNF_DESCR"]].astype(str).reset_index(drop=True)
+        if 'impact' in item:
+            result.update({column: item['impact'][column].sum() for column in IMPACT_COLUMNS})
+            data = pd.concat([data, item['impact'][IMPACT_COLUMNS]], axis=1)
+        results.append(result)
+        if not data.empty:
+            matches.append(data.assign(MEASURE=item['title']))
+    results = pd.DataFrame(results, columns=["MEASURE", "TRIGGERED", "MATCHES"] + IMPACT_COLUMNS)
+    matches = pd.concat(matches, ignore_index=True) if matches else pd.DataFrame(
+        columns=["BNF_CODE", "BNF_DESCRIPTION", "CHEMICAL_SUBSTANCE_BNF_DESCR", "MEASURE"]
+    )
+    return {"measure_results": results, "measure_matches": matches}
+
+####### MEASURE DEFINITION CHANGES #######
+
+CODE_UNIVERSE_FILE = os.path.join("..", "data", "bnf_code_universe.parquet")
+MEASURE_STATE_FILE = os.path.join("..", "data", "measure_definitions.json")
+# Fields of a loaded measure which decide the codes it matches
+DEFINITION_FIELDS = ["testing_type", "testing_type_data", "testing_include", "testing_exclude"]
+
+def update_code_universe(*dfs, universe_file=CODE_UNIVERSE_FILE):
+    """
+    Adds the codes in dfs to the stored universe of every BNF code seen, one row per code with
+    its most recent description, and returns it.
+    """
+    columns = ["BNF_CODE", "BNF_DESCRIPTION", "CHEMICAL_SUBSTANCE_BNF_DESCR"]
+    frames = [pd.read_parquet(universe_file)] if os.path.exists(universe_file) else []
+    frames += [df[[column for column in columns if column in df.columns]].drop_duplicates().astype(str) for df in dfs]
+    universe = pd.concat(frames, ignore_index=True).drop_duplicates("BNF_CODE", keep="last")
+    universe = universe.sort_values("BNF_CODE").reset_index(drop=True)
+    os.makedirs(os.path.dirname(universe_file), exist_ok=True)
+    universe.to_parquet(universe_file, index=False)
+    return universe
+
+def load_code_universe(universe_file=CODE_UNIVERSE_FILE):
+    return pd.read_parquet(universe_file)
+
+def measure_definition(measure_data):
+    return {field: measure_data.get(field) for field in DEFINITION_FIELDS}
+
+def definition_hash(definition):
+    return hashlib.sha256(json.dumps(definition, sort_keys=True).encode()).hexdigest()
+
+def save_measure_definitions(measures, state_file=MEASURE_STATE_FILE):
+    # Records the current definitions once their changes have been reported, so changes found by
+    # a run that then fails are reported again by the next one
+    testing_true, _, _ = measures
+    state = {}
+    for measure_data in testing_true:
+        definition = measure_definition(measure_data)
+        state[measure_data['filename']] = {"hash": definition_hash(definition), "definition": definition}
+    os.makedirs(os.path.dirname(state_file), exist_ok=True)
+    tmp_file = f"{state_file}.tmp"
+    with open(tmp_file, 'w') as f:
+        json.dump(state, f, indent=4)
+    os.replace(tmp_file, state_file)
+
+def revalidate_measures(universe, measures=None, state_file=MEASURE_STATE_FILE, save=False):
+    """
+    Finds measures whose definition has changed since it was last seen and re-evaluates the old
+    and new definitions against the code universe. Unchanged measures are skipped, so this takes
+    seconds. Returns one entry per changed or new measure with the codes added and removed.
+    The definitions are only recorded as seen with save=True; the monthly run records them
+    after the testing report is written.
+    """
+    if measures is None:
+        measures = load_measures()
+    testing_true, _, _ = measures
+    state = {}
+    # The first run only records the definitions, so every measure is not reported as new
+    first_run = not os.path.exists(state_file)
+    if not first_run:
+        with open(state_file, 'r') as f:
+            state = json.load(f)
+
+    changes = []
+    for measure_data in testing_true:
+        definition = measure_definition(measure_data)
+        current_hash = definition_hash(definition)
+        previous = state.get(measure_data['filename'])
+        if previous and previous["hash"] == current_hash:
+            continue
+        matched = measures_filter(universe, measure_data)["data"]
+        change = {"title": f"{measure_data['filename']}.json", "matches": len(matched)}
+        if previous:
+            # Both definitions against today's universe, so only the edit shows up as a difference
+            previous_matched = measures_filter(universe, dict(measure_data, **previous["definition"]))["data"]
+            change["added"] = matched[~matched["BNF_CODE"].isin(previous_matched["BNF_CODE"])]
+            change["removed"] = previous_matched[~previous_matched["BNF_CODE"].isin(matched["BNF_CODE"])]
+        if not first_run:
+            changes.append(change)
+
+    if save:
+        save_measure_definitions(measures, state_file)
+    return changes
+
+def definition_change_table(changes):
+    # Codes added to or removed from each changed measure, for the structured outputs
+    rows = []
+    for change in changes:
+        for key, label in (("added", "ADDED"), ("removed", "REMOVED")):
+            if key in change and not change[key].empty:
+                rows.append(change[key][["BNF_CODE", "BNF_DESCRIPTION"]].assign(MEASURE=change["title"], CHANGE=label))
+    if not rows:
+        return pd.DataFrame(columns=["BNF_CODE", "BNF_DESCRIPTION", "MEASURE", "CHANGE"])
+    return pd.concat(rows, ignore_index=True)
+
 ####### HTML REPORT CREATION #######
 
-def write_monthly_testing_report_html(triggered_tests, passed_tests, testing_false, testing_none, date):
+def write_monthly_testing_report_html(triggered_tests, passed_tests, testing_false, testing_none, date, definition_changes=None):
     reports_dir = os.path.join("..", "reports")
     os.makedirs(reports_dir, exist_ok=True)
 
@@ -354,6 +530,19 @@ def write_monthly_testing_report_html(triggered_tests, passed_tests, testing_fal
         <p><a href="https://html-preview.github.io/?url=https://github.com/chrisjwood16/openprescribing_tests/blob/main/reports/list_test_reports.html">View previous reports</a></p>
     """
 
+    # Measures edited since the last run, with the codes the edit now matches or no longer matches
+    if definition_changes:
+        report += "<h2>Measure definition changes:</h2>"
+        for change in definition_changes:
+            report += f"<a href='https://github.com/ebmdatalab/openprescribing/tree/main/openprescribing/measures/definitions/{change['title']}'><h3>{change['title']}</h3></a>"
+            if "added" not in change:
+                report += f"<p>New measure, matches {change['matches']} codes</p>"
+                continue
+            report += f"<p>{len(change['added'])} codes now matched, {len(change['removed'])} codes no longer matched</p>"
+            table = definition_change_table([change])
+            if not table.empty:
+                report += f"<p>{table[['CHANGE', 'BNF_CODE', 'BNF_DESCRIPTION']].to_html(index=False, classes='table')}</p>"
+
     # Check if there are any triggered tests
     if len(triggered_tests) == 0:
         report += "<h3>All tests passed</h3>"
@@ -363,6 +552,16 @@ def write_monthly_testing_report_html(triggered_tests, passed_tests, testing_fal
             report += f"<a href='https://github.com/ebmdatalab/openprescribing/tree/main/openprescribing/measures/definitions/{item['title']}'><h3>{item['title']} {question_svg}</h3></a>"
             report += f"<p>{item['comments']}</p>"
             df = item['data'][["BNF_CODE", "BNF_DESCRIPTION", "CHEMICAL_SUBSTANCE_BNF_DESCR"]]
+            # Parsed strength and dose count, to check against the strengths the measure expects
+            strengths = strength_utils.parse_strengths(df["BNF_DESCRIPTION"])
+            df = pd.concat([df, strengths[["STRENGTH", "STRENGTH_UNIT", "DOSES"]]], axis=1)
+            if 'impact' in item:
+                impact = item['impact']
+                report += (
+                    f"<p>Prescribed in {date}: {impact['ITEMS'].sum():,.0f} items, "
+                    f"quantity {impact['TOTAL_QUANTITY'].sum():,.0f}, cost &pound;{impact['ACTUAL_COST'].sum():,.2f}</p>"
+                )
+                df = pd.concat([df.reset_index(drop=True), impact[IMPACT_COLUMNS]], axis=1)
             report += f"<p>{df.to_html(index=False, classes='table')}</p>"
         report += "<h2>Tests passed:</h2>"
         if len(passed_tests) == 0:
@@ -446,6 +645,19 @@ def generate_list_reports_html():
             border-radius: 10px;
             box-shadow: 0px 2px 5px rgba(0, 0, 0, 0.1);
         }}
+        table {{
+            border-collapse: collapse;
+            margin-top: 10px;
+        }}
+        th, td {{
+            border: 1px solid #333;
+            padding: 4px 8px;
+            text-align: right;
+        }}
+        th {{
+            background-color: #0485d1;
+            color: white;
+        }}
     </style>
     </head>
     <body>
@@ -466,9 +678,14 @@ def generate_list_reports_html():
         link = f"https://html-preview.github.io/?url=https://github.com/chrisjwood16/openprescribing_tests/blob/main/reports/{html_file}"
         html_content += f'<li><a href="{link}">{title}</a></li>\n'
 
+    # Trend over the last two years from the summary cube, which is updated as each month is written
+    trend = output_utils.summary_trend(["MEASURE_TRIGGERS"], last_months=24)
+    html_content += "</ul>"
+    if not trend.empty:
+        html_content += f"<h3>Measures triggered per month</h3>{trend.iloc[::-1].reset_index().to_html(index=False)}"
+
     # End the HTML content
     html_content += """
-    </ul>
     </div>
     </body>
     </html>
@@ -478,14 +695,20 @@ def generate_list_reports_html():
     with open(os.path.join(reports_dir, 'list_test_reports.html'), 'w') as f:
         f.write(html_content)
 
-def run_tests(bnf_codes_df, date_for):
+    # Combine the monthly structured outputs alongside the index
+    output_utils.build_rollups(output_utils.TESTING_TABLES)
+
+def load_measures():
     folder_path = '../measures_to_test'  # Temporary line to test locally
-    testing_true, testing_false, testing_none = read_json_files_in_folder(folder_path) # Temporary line to test locally
+    return read_json_files_in_folder(folder_path) # Temporary line to test locally
 
-    #testing_true, testing_false, testing_none  = read_json_files_in_github() # Uncomment this line to use GitHub files after testing locally
+    #return read_json_files_in_github() # Uncomment this line to use GitHub files after testing locally
 
-    # Load the CSV file into a pandas DataFrame - Remove this line to use passed variable version after testing
-    bnf_codes_df = pd.read_csv('new_bnf_codes.csv') # Temporary line to test locally - Remove this line after testing - will use passed variable version
+def run_tests(bnf_codes_df, date_for, measures=None, update_index=True, impact=True, definition_changes=None):
+    # Measures can be loaded once and passed in when testing many months
+    if measures is None:
+        measures = load_measures()
+    testing_true, testing_false, testing_none = measures
 
     # Create an empty list for triggered tests
     triggered_tests = []
@@ -498,5 +721,16 @@ def run_tests(bnf_codes_df, date_for):
         else:
             passed_tests.append(test_result)
 
-    write_monthly_testing_report_html(triggered_tests, passed_tests, testing_false, testing_none, date_for)
-    generate_list_reports_html()
\ No newline at end of file
+    if impact:
+        add_impact(triggered_tests, date_for)
+
+    write_monthly_testing_report_html(triggered_tests, passed_tests, testing_false, testing_none, date_for, definition_changes)
+    tables = measure_result_tables(triggered_tests, passed_tests)
+    if definition_changes is not None:
+        tables["measure_definition_changes"] = definition_change_table(definition_changes)
+    output_utils.write_month_outputs(date_for, tables)
+    if definition_changes is not None:
+        # Only now that the changes are in the report are the new definitions recorded as seen
+        save_measure_definitions(measures)
+    if update_index:
+        generate_list_reports_html()
@@ -1,47 +1,65 @@
 import pandas as pd
+import numpy as np
 import os
+import output_utils
 
 class CompareLatest:
-    def __init__(self, df_existing, df_latest, exclude_chapters=[]):
+    def __init__(self, df_existing, df_latest, exclude_chapters=[], new_bnf_codes_csv=None, existing_keys=None):
         self.df_existing = df_existing
         self.df_latest = df_latest
         self.exclude_chapters = exclude_chapters
+        # Optional spill_utils.KeySpill of the history, used instead of df_existing when it is too large for memory
+        self.existing_keys = existing_keys
+        # Optional path to also write the new BNF codes to, e.g. for use in notebooks
+        self.new_bnf_codes_csv = new_bnf_codes_csv
         self.new_chem_subs = None
         self.new_bnf_codes = None
         self.new_bnf_descriptions = None
         if self.exclude_chapters:
-            self.df_existing = self.exclude_these_chapters(self.df_existing, self.exclude_chapters)
+            if self.df_existing is not None:
+                self.df_existing = self.exclude_these_chapters(self.df_existing, self.exclude_chapters)
             self.df_latest = self.exclude_these_chapters(self.df_latest, self.exclude_chapters)
         self.find_bnf_code_only_in_latest()
         self.find_bnf_description_only_in_latest()
         self.find_chemical_substance_bnf_descr_only_in_latest()
         self.new_desc_only = self.find_unique_rows(self.new_bnf_descriptions, self.new_bnf_codes)
 
-    def find_bnf_code_only_in_latest(self):
-        latest_codes = set(self.df_latest['BNF_CODE'])
-        existing_codes = set(self.df_existing['BNF_CODE'])
-        unique_codes = latest_codes - existing_codes
+    @staticmethod
+    def only_in_latest(latest, existing):
+        # Categoricals sharing a CategoryRegistry are compared on their integer codes
+        if isinstance(latest.dtype, pd.CategoricalDtype) and isinstance(existing.dtype, pd.CategoricalDtype):
+            latest_categories = latest.cat.categories
+            existing_categories = existing.cat.categories
+            n = min(len(latest_categories), len(existing_categories))
+            if latest_categories[:n].equals(existing_categories[:n]):
+                seen = np.zeros(len(latest_categories) + 1, dtype=bool)
+                existing_codes = existing.cat.codes.to_numpy()
+                seen[existing_codes[(existing_codes >= 0) & (existing_codes < len(latest_categories))]] = True
+                latest_codes = latest.cat.codes.to_numpy()
+                return pd.Series((latest_codes >= 0) & ~seen[latest_codes], index=latest.index)
+
+        unique_values = set(latest) - set(existing)
+        return latest.isin(unique_values)
 
-        result = self.df_latest[self.df_latest['BNF_CODE'].isin(unique_codes)]
+    def new_in_latest(self, column):
+        if self.existing_keys is not None:
+            return ~self.existing_keys.contains(column, self.df_latest[column])
+        return self.only_in_latest(self.df_latest[column], self.df_existing[column])
+
+    def find_bnf_code_only_in_latest(self):
+        result = self.df_latest[self.new_in_latest('BNF_CODE')]
         result = self.sort_by_bnf_code(result)
         self.new_bnf_codes = result
-        self.new_bnf_codes.to_csv('new_bnf_codes.csv')
+        if self.new_bnf_codes_csv:
+            self.new_bnf_codes.to_csv(self.new_bnf_codes_csv)
 
     def find_bnf_description_only_in_latest(self):
-        latest_descriptions = set(self.df_latest['BNF_DESCRIPTION'])
-        existing_descriptions = set(self.df_existing['BNF_DESCRIPTION'])
-        unique_descriptions = latest_descriptions - existing_descriptions
-
-        result = self.df_latest[self.df_latest['BNF_DESCRIPTION'].isin(unique_descriptions)]
+        result = self.df_latest[self.new_in_latest('BNF_DESCRIPTION')]
         result = self.sort_by_bnf_code(result)
         self.new_bnf_descriptions = result
 
     def find_chemical_substance_bnf_descr_only_in_latest(self):
-        latest_substances = set(self.df_latest['CHEMICAL_SUBSTANCE_BNF_DESCR'])
-        existing_substances = set(self.df_existing['CHEMICAL_SUBSTANCE_BNF_DESCR'])
-        unique_substances = latest_substances - existing_substances
-
-        result = self.df_latest[self.df_latest['CHEMICAL_SUBSTANCE_BNF_DESCR'].isin(unique_substances)]
+        result = self.df_latest[self.new_in_latest('CHEMICAL_SUBSTANCE_BNF_DESCR')]
         result = self.sort_by_bnf_code(result)
         self.new_chem_subs = result
 
@@ -92,6 +110,14 @@ class CompareLatest:
         # Drop the indicator column before returning
         unique_rows = unique_rows.drop(columns=['_merge'])
 
+        # The merge orders categoricals by category code, i.e. the order they were first seen;
+        # order by value instead, as the merge does for plain strings
+        categorical = [c for c in unique_rows.columns if isinstance(unique_rows[c].dtype, pd.CategoricalDtype)]
+        if categorical:
+            unique_rows = unique_rows.sort_values(
+                list(unique_rows.columns), key=lambda c: c.astype(object) if c.name in categorical else c, kind='stable'
+            )
+
         return unique_rows
       
     def return_new_chem_subs(self):
@@ -106,7 +132,12 @@ class CompareLatest:
     def return_new_desc_only(self):
         return self.new_desc_only
 
-def write_monthly_report_html(chem_subs, bnf_codes, bnf_descriptions, date):
+    def find_similar_descriptions(self, k=3, min_similarity=0.5, index=None):
+        # Nearest existing descriptions for new codes and new descriptions - likely predecessors
+        from similarity_utils import find_similar_descriptions
+        return find_similar_descriptions(self.df_existing, [self.new_bnf_codes, self.new_desc_only], k, min_similarity, index)
+
+def write_monthly_report_html(chem_subs, bnf_codes, bnf_descriptions, date, similar=None):
     reports_dir = os.path.join("..", "reports")
     os.makedirs(reports_dir, exist_ok=True)
 
@@ -119,6 +150,15 @@ def write_monthly_report_html(chem_subs, bnf_codes, bnf_descriptions, date):
     else:
         jan_alert = ''
 
+    # Show likely predecessors of new items if they have been looked up
+    similar_section = ''
+    if similar is not None:
+        similar_section = (
+            '<h3>Possible Predecessors</h3>'
+            '<p>Most similar existing descriptions for each new code or description (may indicate a renamed or re-coded product)</p>'
+            f"{similar.to_html(index=False, classes='table')}"
+        )
+
     # Write a function to generate the HTML report
     report = f"""
     <html>
@@ -209,6 +249,7 @@ def write_monthly_report_html(chem_subs, bnf_codes, bnf_descriptions, date):
         <h3>New BNF Descriptions</h3>
         <p>Identify new descriptions only (not new BNF code)</p>
         {bnf_descriptions.to_html(index=False, classes='table')}
+        {similar_section}
     </div>
     </body>
     </html>
@@ -220,6 +261,14 @@ def write_monthly_report_html(chem_subs, bnf_codes, bnf_descriptions, date):
 
     print(f"Report written to {reports_dir}/monthly_report_{date}.html")
 
+    # The same tables as data, for tools that should not have to parse the HTML
+    output_utils.write_month_outputs(date, {
+        "new_chem_subs": chem_subs,
+        "new_bnf_codes": bnf_codes,
+        "new_descriptions": bnf_descriptions,
+        "similar_descriptions": similar,
+    })
+
 def generate_list_reports_html():
     reports_dir = os.path.join("..", "reports")
     
@@ -270,6 +319,19 @@ def generate_list_reports_html():
             border-radius: 10px;
             box-shadow: 0px 2px 5px rgba(0, 0, 0, 0.1);
         }}
+        table {{
+            border-collapse: collapse;
+            margin-top: 10px;
+        }}
+        th, td {{
+            border: 1px solid #333;
+            padding: 4px 8px;
+            text-align: right;
+        }}
+        th {{
+            background-color: #0485d1;
+            color: white;
+        }}
     </style>
     </head>
     <body>
@@ -290,9 +352,14 @@ def generate_list_reports_html():
         link = f"https://html-preview.github.io/?url=https://github.com/chrisjwood16/openprescribing_tests/blob/main/reports/{html_file}"
         html_content += f'<li><a href="{link}">{title}</a></li>\n'
 
+    # Trend over the last two years from the summary cube, which is updated as each month is written
+    trend = output_utils.summary_trend(["NEW_CHEM_SUBS", "NEW_BNF_CODES", "NEW_DESCRIPTIONS"], last_months=24)
+    html_content += "</ul>"
+    if not trend.empty:
+        html_content += f"<h3>New items per month</h3>{trend.iloc[::-1].reset_index().to_html(index=False)}"
+
     # End the HTML content
     html_content += """
-    </ul>
     </div>
     </body>
     </html>
@@ -300,4 +367,7 @@ def generate_list_reports_html():
 
     # Write the HTML content to list_reports.html
     with open(os.path.join(reports_dir, 'list_reports.html'), 'w') as f:
-        f.write(html_content)
\ No newline at end of file
+        f.write(html_content)
+
+    # Combine the monthly structured outputs alongside the index
+    output_utils.build_rollups(output_utils.NEW_ITEM_TABLES)